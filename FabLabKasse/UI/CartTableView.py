@@ -18,61 +18,164 @@
 # see <http://www.gnu.org/licenses/>.
 
 from qtpy.QtWidgets import QTableView
-from qtpy import QtGui, QtCore
-import functools
+from qtpy import QtCore
 from FabLabKasse.UI.GUIHelper import resize_table_columns
 
 
-class CartTableView(QTableView):
-    """Extends the funxtionality of a normal QTableView in order to supply a cart-view
+def _blocks(rows):
+    """split ascending row numbers into blocks of consecutive rows
 
-    for usage see the cart-view in Kassenterminal and the cart-view in the app-checkout
+    :return: list of (first row, last row)
+
+    >>> _blocks([1, 2, 3, 7, 9, 10])
+    [(1, 3), (7, 7), (9, 10)]
     """
+    blocks = []
+    for row in rows:
+        if blocks and blocks[-1][1] == row - 1:
+            blocks[-1] = (blocks[-1][0], row)
+        else:
+            blocks.append((row, row))
+    return blocks
 
-    def update_cart(self, shoppingBackend):
-        """update table with current order lines"""
-        order_lines = shoppingBackend.get_order_lines()
 
-        # Initialize basic model for table
-        order_model = QtGui.QStandardItemModel(len(order_lines), 4)
-        order_model.setHorizontalHeaderItem(0, QtGui.QStandardItem("Anzahl"))
-        order_model.setHorizontalHeaderItem(1, QtGui.QStandardItem("Einheit"))
-        order_model.setHorizontalHeaderItem(2, QtGui.QStandardItem("Artikel"))
-        order_model.setHorizontalHeaderItem(3, QtGui.QStandardItem("Einzelpreis"))
-        order_model.setHorizontalHeaderItem(4, QtGui.QStandardItem("Gesamtpreis"))
+class CartTableModel(QtCore.QAbstractTableModel):
+    """table model showing the order lines of the current order
 
-        # Update Order lines
+    The model keeps the formatted texts of every line. :meth:`update_cart`
+    compares them with the current order lines and only announces the rows
+    that were actually inserted, removed or changed, so that the view does
+    not need to rebuild the whole table on every quantity keystroke.
+    Consecutive rows are announced together, so that even large changes
+    only need few signals.
+
+    The order line id of a row is available as ``QtCore.Qt.UserRole`` data.
+    """
 
-        for i, line in enumerate(order_lines):
-            qty = QtGui.QStandardItem(shoppingBackend.format_qty(line.qty))
-            qty.setData(line.order_line_id)
-            order_model.setItem(i, 0, qty)
+    HEADERS = ["Anzahl", "Einheit", "Artikel", "Einzelpreis", "Gesamtpreis"]
 
-            uos = QtGui.QStandardItem(line.unit)
-            order_model.setItem(i, 1, uos)
+    def __init__(self, parent=None):
+        QtCore.QAbstractTableModel.__init__(self, parent)
+        # list of (order_line_id, (texts for every column))
+        self._rows = []
 
-            name = QtGui.QStandardItem(line.name)
-            order_model.setItem(i, 2, name)
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self._rows)
 
-            price_unit = QtGui.QStandardItem(
-                shoppingBackend.format_money(line.price_per_unit)
+    def columnCount(self, parent=QtCore.QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self.HEADERS)
+
+    def data(self, index, role=QtCore.Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        (order_line_id, texts) = self._rows[index.row()]
+        if role == QtCore.Qt.DisplayRole:
+            return texts[index.column()]
+        if role == QtCore.Qt.UserRole:
+            return order_line_id
+        return None
+
+    def headerData(self, section, orientation, role=QtCore.Qt.DisplayRole):
+        if orientation == QtCore.Qt.Horizontal and role == QtCore.Qt.DisplayRole:
+            return self.HEADERS[section]
+        return None
+
+    def order_line_id(self, row):
+        """return the order line id shown in the given row"""
+        return self._rows[row][0]
+
+    def update_cart(self, shoppingBackend):
+        """update the model to show the current order lines of shoppingBackend"""
+        new_rows = [
+            (
+                line.order_line_id,
+                (
+                    shoppingBackend.format_qty(line.qty),
+                    line.unit,
+                    line.name,
+                    shoppingBackend.format_money(line.price_per_unit),
+                    shoppingBackend.format_money(line.price_subtotal),
+                ),
             )
-            order_model.setItem(i, 3, price_unit)
+            for line in shoppingBackend.get_order_lines()
+        ]
+        self._set_rows(new_rows)
+
+    def clear(self):
+        """remove all lines"""
+        self._set_rows([])
+
+    def _set_rows(self, new_rows):
+        new_ids = [order_line_id for (order_line_id, _) in new_rows]
+        new_id_set = set(new_ids)
 
-            subtotal = QtGui.QStandardItem(
-                shoppingBackend.format_money(line.price_subtotal)
+        # remove lines that no longer exist, last block first so that indices stay valid
+        removed = [
+            row
+            for row, (order_line_id, _) in enumerate(self._rows)
+            if order_line_id not in new_id_set
+        ]
+        for first, last in reversed(_blocks(removed)):
+            self.beginRemoveRows(QtCore.QModelIndex(), first, last)
+            del self._rows[first : last + 1]
+            self.endRemoveRows()
+
+        old_ids = [order_line_id for (order_line_id, _) in self._rows]
+        old_id_set = set(old_ids)
+        if old_ids != [i for i in new_ids if i in old_id_set]:
+            # the remaining lines were reordered, which the backends never do
+            self.beginResetModel()
+            self._rows = list(new_rows)
+            self.endResetModel()
+            return
+
+        # insert new lines, first block first so that the following
+        # rows are at their final position
+        inserted = [row for row, i in enumerate(new_ids) if i not in old_id_set]
+        for first, last in _blocks(inserted):
+            self.beginInsertRows(QtCore.QModelIndex(), first, last)
+            self._rows[first:first] = new_rows[first : last + 1]
+            self.endInsertRows()
+
+        # update changed lines
+        changed = [
+            row for row, new_row in enumerate(new_rows) if self._rows[row] != new_row
+        ]
+        self._rows = list(new_rows)
+        for first, last in _blocks(changed):
+            self.dataChanged.emit(
+                self.index(first, 0), self.index(last, len(self.HEADERS) - 1)
             )
-            order_model.setItem(i, 4, subtotal)
 
-        # Set Model
-        self.setModel(order_model)
 
-        # Change column width to useful values
-        # needs to be delayed so that resize events for the scrollbar happens first, otherwise it reports a scrollbar width of 100px at the very first call
-        QtCore.QTimer.singleShot(1, self.resize_table)
-        # the 100ms delay is a workaround that is necessary because the first call often comes too early.
-        # It is not clear if this workaround is still necessary, but who cares...
-        QtCore.QTimer.singleShot(100, self.resize_table)
+class CartTableView(QTableView):
+    """Extends the funxtionality of a normal QTableView in order to supply a cart-view
+
+    for usage see the cart-view in Kassenterminal and the cart-view in the app-checkout
+    """
+
+    def __init__(self, parent=None):
+        QTableView.__init__(self, parent)
+        self.setModel(CartTableModel(self))
+
+    def update_cart(self, shoppingBackend):
+        """update table with current order lines"""
+        self.model().update_cart(shoppingBackend)
+
+    def clear_cart(self):
+        """show an empty cart"""
+        self.model().clear()
+
+    def viewportEvent(self, event):
+        # Change column width to useful values whenever the usable width changes,
+        # e.g. when the widget is resized or the vertical scrollbar appears.
+        if event.type() == QtCore.QEvent.Resize:
+            self.resize_table()
+        return QTableView.viewportEvent(self, event)
 
     def resize_table(self):
         # Update column width to useful values
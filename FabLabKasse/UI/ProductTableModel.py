@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# FabLabKasse, a Point-of-Sale Software for FabLabs and other public and trust-based workshops.
+#
+# This program is free software: you can redistribute it and/or modify it under the terms of the GNU
+# General Public License as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with this program. If not,
+# see <http://www.gnu.org/licenses/>.
+
+from qtpy import QtGui, QtCore
+
+
+class ProductTableModel(QtCore.QAbstractTableModel):
+    """table model showing a list of products
+
+    The cell texts are only computed in :meth:`data` when the view asks for
+    them, i.e. for the visible rows. Setting a new product list therefore
+    does not depend on the number of products.
+
+    The product id of a row is available as ``QtCore.Qt.UserRole`` data.
+    """
+
+    HEADERS = ["Nr", "Artikel", "Lagerort", "Einheit", "Preis"]
+
+    def __init__(self, format_money, parent=None):
+        """
+        :param format_money: function that formats a price for display, e.g. :meth:`AbstractShoppingBackend.format_money`
+        """
+        QtCore.QAbstractTableModel.__init__(self, parent)
+        self._format_money = format_money
+        self._products = []
+        # smaller font for the product id, shared by all rows
+        self._light_font = QtGui.QFont()
+        self._light_font.setPointSize(10)
+
+    def set_products(self, products):
+        """show the given list of products
+
+        :type products: list(Product)
+        """
+        self.beginResetModel()
+        self._products = products
+        self.endResetModel()
+
+    def product_id(self, row):
+        """return the id of the product shown in the given row"""
+        return self._products[row].prod_id
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self._products)
+
+    def columnCount(self, parent=QtCore.QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self.HEADERS)
+
+    def data(self, index, role=QtCore.Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        product = self._products[index.row()]
+        column = index.column()
+        if role == QtCore.Qt.DisplayRole:
+            if column == 0:
+                return str(product.prod_id)
+            elif column == 1:
+                return product.name
+            elif column == 2:
+                return product.location
+            elif column == 3:
+                return product.unit
+            else:
+                return self._format_money(product.price)
+        if role == QtCore.Qt.FontRole and column == 0:
+            return self._light_font
+        if role == QtCore.Qt.UserRole:
+            return product.prod_id
+        return None
+
+    def headerData(self, section, orientation, role=QtCore.Qt.DisplayRole):
+        if orientation == QtCore.Qt.Horizontal and role == QtCore.Qt.DisplayRole:
+            return self.HEADERS[section]
+        return None
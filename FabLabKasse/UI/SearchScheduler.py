@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# FabLabKasse, a Point-of-Sale Software for FabLabs and other public and trust-based workshops.
+#
+# This program is free software: you can redistribute it and/or modify it under the terms of the GNU
+# General Public License as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with this program. If not,
+# see <http://www.gnu.org/licenses/>.
+
+import logging
+from qtpy import QtCore
+
+
+class _SearchTask(QtCore.QRunnable):
+
+    """one search of a SearchScheduler, run in its thread pool"""
+
+    def __init__(self, scheduler, generation, session, searchstr):
+        QtCore.QRunnable.__init__(self)
+        self.scheduler = scheduler
+        self.generation = generation
+        self.session = session
+        self.searchstr = searchstr
+
+    def run(self):
+        if self.generation != self.scheduler.generation:
+            # a newer search was requested while this one was waiting
+            return
+        try:
+            result = self.session.search(self.searchstr)
+        except Exception:
+            logging.exception("search for {0!r} failed".format(self.searchstr))
+            return
+        self.scheduler._searchFinished.emit(self.generation, result)
+
+
+class SearchScheduler(QtCore.QObject):
+    """search-as-you-type without blocking the GUI
+
+    :meth:`schedule` waits until the user stopped typing for the debounce
+    interval and then runs the search of the current search session (see
+    :meth:`AbstractShoppingBackend.start_search_session`) in a background
+    thread. Only the results of the latest requested search are emitted by
+    :attr:`resultsReady`, older ones are dropped.
+
+    All searches run one after another in the same background thread,
+    because a search session must not be used by two threads at once.
+    """
+
+    resultsReady = QtCore.Signal(object)
+    """(categories, products) of the latest search"""
+
+    _searchFinished = QtCore.Signal(int, object)
+
+    def __init__(self, shopping_backend, debounce_interval=150, parent=None):
+        """
+        :param shopping_backend: shopping backend that is searched
+        :type shopping_backend: AbstractShoppingBackend
+        :param debounce_interval: time in milliseconds to wait for further keystrokes before searching
+        """
+        QtCore.QObject.__init__(self, parent)
+        self.shopping_backend = shopping_backend
+        # incremented for every request, results of older requests are dropped
+        self.generation = 0
+        self._session = None
+        self._searchstr = None
+        self._pool = QtCore.QThreadPool(self)
+        self._pool.setMaxThreadCount(1)
+        self._timer = QtCore.QTimer(self)
+        self._timer.setSingleShot(True)
+        self._timer.setInterval(debounce_interval)
+        self._timer.timeout.connect(self._start_search)
+        self._searchFinished.connect(self._on_search_finished)
+
+    def _get_session(self):
+        if self._session is None:
+            self._session = self.shopping_backend.start_search_session()
+        return self._session
+
+    def schedule(self, searchstr):
+        """search searchstr after the debounce interval, cancelling all earlier requests"""
+        self.generation += 1
+        self._searchstr = searchstr
+        self._timer.start()
+
+    def _start_search(self):
+        self._pool.start(
+            _SearchTask(self, self.generation, self._get_session(), self._searchstr)
+        )
+
+    def _on_search_finished(self, generation, result):
+        if generation == self.generation:
+            self.resultsReady.emit(result)
+
+    def search_now(self, searchstr):
+        """search searchstr in the calling thread, cancelling all requested searches
+
+        :return: (categories, products), see :meth:`AbstractShoppingBackend.search_from_text`
+        """
+        self.cancel()
+        self._pool.waitForDone()
+        return self._get_session().search(searchstr)
+
+    def cancel(self):
+        """drop all requested searches and their results"""
+        self.generation += 1
+        self._timer.stop()
+        self._pool.clear()
+
+    def reset(self):
+        """cancel all searches and start a new search session next time
+
+        This is necessary when a new search starts or when the products changed.
+        """
+        self.cancel()
+        self._session = None
+
+    def is_busy(self):
+        """is a search requested or still running?"""
+        return self._timer.isActive() or self._pool.activeThreadCount() > 0
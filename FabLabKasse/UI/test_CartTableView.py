@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# FabLabKasse, a Point-of-Sale Software for FabLabs and other public and trust-based workshops.
+#
+# This program is free software: you can redistribute it and/or modify it under the terms of the GNU
+# General Public License as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with this program. If not,
+# see <http://www.gnu.org/licenses/>.
+
+"""unittests for CartTableView.py"""
+
+import unittest
+from unittest import mock
+from configparser import ConfigParser
+from qtpy import QtCore
+from FabLabKasse.UI.CartTableView import CartTableModel
+from FabLabKasse.shopping.backend import dummy
+
+
+class CartTableModelTestCase(unittest.TestCase):
+
+    """Test that CartTableModel only announces changed rows"""
+
+    def setUp(self):
+        cfg = ConfigParser()
+        cfg.read_string(
+            "[payup_methods]\n"
+            "overpayment_product_id = 9999\n"
+            "payout_impossible_product_id = 9994\n"
+        )
+        with mock.patch("FabLabKasse.scriptHelper.getConfig", return_value=cfg):
+            self.backend = dummy.ShoppingBackend(cfg)
+        self.backend.set_current_order(self.backend.create_order())
+        self.model = CartTableModel()
+        self.events = []
+        self.model.rowsInserted.connect(
+            lambda parent, first, last: self.events.append(("insert", first, last))
+        )
+        self.model.rowsRemoved.connect(
+            lambda parent, first, last: self.events.append(("remove", first, last))
+        )
+        self.model.dataChanged.connect(
+            lambda first, last, *roles: self.events.append(
+                ("change", first.row(), last.row())
+            )
+        )
+        self.model.modelReset.connect(lambda: self.events.append(("reset",)))
+
+    def update(self):
+        """update the model and return the emitted signals"""
+        self.events = []
+        self.model.update_cart(self.backend)
+        return self.events
+
+    def assertShowsBackend(self):
+        lines = self.backend.get_order_lines()
+        self.assertEqual(self.model.rowCount(), len(lines))
+        for row, line in enumerate(lines):
+            self.assertEqual(self.model.order_line_id(row), line.order_line_id)
+            index = self.model.index(row, 4)
+            self.assertEqual(index.data(QtCore.Qt.UserRole), line.order_line_id)
+            self.assertEqual(
+                index.data(), self.backend.format_money(line.price_subtotal)
+            )
+
+    def test_update(self):
+        for i in range(100):
+            self.backend.add_order_line(2000 + i % 50, 1)
+        # consecutive rows are announced together
+        self.assertEqual(self.update(), [("insert", 0, 99)])
+        self.assertShowsBackend()
+        self.assertEqual(self.update(), [])
+
+        lines = self.backend.get_order_lines()
+        self.backend.update_quantity(lines[42].order_line_id, 5)
+        self.assertEqual(self.update(), [("change", 42, 42)])
+        self.assertShowsBackend()
+        for line in lines[60:70]:
+            self.backend.update_quantity(line.order_line_id, 3)
+        self.assertEqual(self.update(), [("change", 60, 69)])
+        self.assertShowsBackend()
+
+        self.backend.delete_order_line(lines[10].order_line_id)
+        self.backend.add_order_line(2001, 2)
+        self.assertEqual(self.update(), [("remove", 10, 10), ("insert", 99, 99)])
+        self.assertShowsBackend()
+
+        lines = self.backend.get_order_lines()
+        for line in lines[20:30] + lines[50:55]:
+            self.backend.delete_order_line(line.order_line_id)
+        for i in range(20):
+            self.backend.add_order_line(2000 + i, 1)
+        self.assertEqual(
+            self.update(),
+            [("remove", 50, 54), ("remove", 20, 29), ("insert", 85, 104)],
+        )
+        self.assertShowsBackend()
+
+        self.model.clear()
+        self.assertEqual(self.model.rowCount(), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
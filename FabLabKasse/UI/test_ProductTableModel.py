@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# FabLabKasse, a Point-of-Sale Software for FabLabs and other public and trust-based workshops.
+#
+# This program is free software: you can redistribute it and/or modify it under the terms of the GNU
+# General Public License as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with this program. If not,
+# see <http://www.gnu.org/licenses/>.
+
+"""unittests for ProductTableModel.py"""
+
+import unittest
+from decimal import Decimal
+from unittest import mock
+from qtpy import QtCore
+from FabLabKasse.UI.ProductTableModel import ProductTableModel
+from FabLabKasse.shopping.backend.abstract import Product
+
+
+class ProductTableModelTestCase(unittest.TestCase):
+
+    """Test that ProductTableModel formats cells on demand"""
+
+    def test_lazy_formatting(self):
+        products = [
+            Product(i, "Produkt {0}".format(i), Decimal(i), "Stück", "Regal")
+            for i in range(100000)
+        ]
+        format_money = mock.Mock(side_effect=lambda price: "{0} €".format(price))
+        model = ProductTableModel(format_money)
+        model.set_products(products)
+        self.assertEqual(model.rowCount(), 100000)
+        format_money.assert_not_called()
+
+        index = model.index(42, 4)
+        self.assertEqual(index.data(), "42 €")
+        format_money.assert_called_once_with(Decimal(42))
+        self.assertEqual(model.index(42, 1).data(), "Produkt 42")
+        self.assertEqual(model.index(42, 0).data(QtCore.Qt.UserRole), 42)
+        self.assertEqual(model.product_id(42), 42)
+        self.assertEqual(model.index(1, 0).data(QtCore.Qt.FontRole).pointSize(), 10)
+
+
+if __name__ == "__main__":
+    unittest.main()
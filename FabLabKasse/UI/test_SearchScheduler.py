@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# FabLabKasse, a Point-of-Sale Software for FabLabs and other public and trust-based workshops.
+#
+# This program is free software: you can redistribute it and/or modify it under the terms of the GNU
+# General Public License as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with this program. If not,
+# see <http://www.gnu.org/licenses/>.
+
+"""unittests for SearchScheduler.py"""
+
+import threading
+import unittest
+from qtpy import QtCore
+from FabLabKasse.UI.SearchScheduler import SearchScheduler
+
+
+class SlowSearchSession(object):
+
+    """search session that records its queries and can be blocked"""
+
+    def __init__(self):
+        self.queries = []
+        self.started = threading.Event()
+        self.unblock = threading.Event()
+        self.unblock.set()
+
+    def search(self, searchstr):
+        self.queries.append(searchstr)
+        self.started.set()
+        self.unblock.wait(10)
+        return ([], [searchstr])
+
+
+class FakeBackend(object):
+    def __init__(self):
+        self.session = SlowSearchSession()
+
+    def start_search_session(self):
+        return self.session
+
+
+class SearchSchedulerTestCase(unittest.TestCase):
+
+    """Test debouncing and dropping of stale results"""
+
+    def setUp(self):
+        self.app = QtCore.QCoreApplication.instance() or QtCore.QCoreApplication([])
+        self.backend = FakeBackend()
+        self.results = []
+
+    def make_scheduler(self, debounce_interval):
+        scheduler = SearchScheduler(self.backend, debounce_interval)
+        scheduler.resultsReady.connect(self.results.append)
+        return scheduler
+
+    def wait_for_results(self, count):
+        """process events until count results arrived (or timeout)"""
+        loop = QtCore.QEventLoop()
+        timer = QtCore.QTimer()
+        timer.timeout.connect(lambda: len(self.results) >= count and loop.quit())
+        timer.start(5)
+        QtCore.QTimer.singleShot(5000, loop.quit)
+        loop.exec_()
+        timer.stop()
+
+    def test_debounce(self):
+        scheduler = self.make_scheduler(50)
+        for searchstr in ["a", "ac", "acr"]:
+            scheduler.schedule(searchstr)
+        self.wait_for_results(1)
+        self.assertEqual(self.backend.session.queries, ["acr"])
+        self.assertEqual(self.results, [([], ["acr"])])
+
+    def test_stale_results(self):
+        scheduler = self.make_scheduler(0)
+        session = self.backend.session
+        session.unblock.clear()
+        scheduler.schedule("a")
+        # wait until the search for "a" runs in the background
+        while not session.started.is_set():
+            self.app.processEvents()
+        scheduler.schedule("ab")
+        session.unblock.set()
+        self.wait_for_results(1)
+        self.assertEqual(session.queries, ["a", "ab"])
+        self.assertEqual(self.results, [([], ["ab"])])
+
+    def test_search_now(self):
+        scheduler = self.make_scheduler(1000)
+        scheduler.schedule("a")
+        self.assertTrue(scheduler.is_busy())
+        self.assertEqual(scheduler.search_now("ab"), ([], ["ab"]))
+        self.assertFalse(scheduler.is_busy())
+        self.assertEqual(self.backend.session.queries, ["ab"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -15,6 +15,7 @@ import sqlite3
 import codecs
 from decimal import Decimal
 from FabLabKasse.faucardPayment.faucardStates import Status, Info
+from FabLabKasse.kassenbuch import has_integer_cent_columns
 
 # from FabLabKasse import scriptHelper
 
@@ -168,6 +169,8 @@ if __name__ == "__main__":
         conKb = sqlite3.connect(args.kassenbuch)
         curKb = conKb.cursor()
         conKb.text_factory = str
+        # does the Kassenbuch have integer cent columns?
+        kbIntegerCents = has_integer_cent_columns(curKb)
     except sqlite3.OperationalError as e:
         print("ERROR: {0}".format(e))
         raise
@@ -256,10 +259,22 @@ if __name__ == "__main__":
                 lastdate = timestamp
 
             # Determine corresponding rechnung
-            curKb.execute(
-                "SELECT rechnung, datum FROM buchung WHERE konto = 'FAUKarte' AND (abs(betrag - ?) < 1e-4) AND datum BETWEEN ? AND ? ",
-                (str(amount), timestamp, timestamp + timedelta(seconds=20)),
-            )
+            if kbIntegerCents:
+                # exact comparison, fall back to the text column if betrag_cent is NULL
+                curKb.execute(
+                    "SELECT rechnung, datum FROM buchung WHERE konto = 'FAUKarte' AND COALESCE(betrag_cent = ?, abs(betrag - ?) < 1e-4) AND datum BETWEEN ? AND ? ",
+                    (
+                        int(amount * 100),
+                        str(amount),
+                        timestamp,
+                        timestamp + timedelta(seconds=20),
+                    ),
+                )
+            else:
+                curKb.execute(
+                    "SELECT rechnung, datum FROM buchung WHERE konto = 'FAUKarte' AND (abs(betrag - ?) < 1e-4) AND datum BETWEEN ? AND ? ",
+                    (str(amount), timestamp, timestamp + timedelta(seconds=20)),
+                )
             safetyCounter = 0
             rechnungsnr = -1
 
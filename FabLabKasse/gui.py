@@ -45,6 +45,8 @@ from FabLabKasse.UI.GUIHelper import (
 from .UI.uic_generated.Kassenterminal import Ui_Kassenterminal
 from .UI.PaymentMethodDialogCode import PaymentMethodDialog
 from .UI.KeyboardDialogCode import KeyboardDialog
+from .UI.ProductTableModel import ProductTableModel
+from .UI.SearchScheduler import SearchScheduler
 
 from . import scriptHelper
 
@@ -89,6 +91,26 @@ def format_decimal(value):
     return str(value).replace(".", locale.localeconv()["decimal_point"])
 
 
+class CatalogLoaderThread(QtCore.QThread):
+
+    """loads products and categories in the background, see AbstractShoppingBackend.load_catalog()"""
+
+    catalogLoaded = QtCore.Signal(object)
+
+    def __init__(self, shopping_backend, parent=None):
+        QtCore.QThread.__init__(self, parent)
+        self.shopping_backend = shopping_backend
+
+    def run(self):
+        try:
+            catalog = self.shopping_backend.load_catalog()
+        except Exception:
+            logging.exception("reloading products and categories failed")
+            return
+        if catalog is not None:
+            self.catalogLoaded.emit(catalog)
+
+
 class Kassenterminal(Ui_Kassenterminal, QtWidgets.QMainWindow):
     def __init__(self):
         logging.info("GUI startup")
@@ -105,6 +127,15 @@ class Kassenterminal(Ui_Kassenterminal, QtWidgets.QMainWindow):
         self.shoppingBackend = ShoppingBackend(cfg)
         """time when the program was started, used for auto-restart"""
         self.startup_time = time.monotonic()
+        # search-as-you-type in the background, see searchItems()
+        self.searchScheduler = SearchScheduler(
+            self.shoppingBackend,
+            cfg.getint("general", "search_debounce_time", fallback=150),
+            self,
+        )
+        self.searchScheduler.resultsReady.connect(self.showSearchResults)
+        # reloaded catalog that is waiting to be used, see applyPendingCatalog()
+        self.pendingCatalog = None
 
         # TODO check at startup for all cfg.get* calls
         cfg.getint("payup_methods", "overpayment_product_id")
@@ -224,6 +255,12 @@ class Kassenterminal(Ui_Kassenterminal, QtWidgets.QMainWindow):
         # Disable vertical header on table_order
         self.table_order.verticalHeader().setVisible(False)
 
+        # Products are shown by a model that formats only the visible rows
+        self.productModel = ProductTableModel(self.shoppingBackend.format_money, self)
+        self.table_products.setModel(self.productModel)
+        # adjust height: large enough for precise touching, chosen such that the last item is "half cut off" to make it obvious that you need to scroll further
+        self.table_products.verticalHeader().setDefaultSectionSize(42)
+
         # Shopping carts/orders
         self.updateOrder()
 
@@ -256,6 +293,54 @@ class Kassenterminal(Ui_Kassenterminal, QtWidgets.QMainWindow):
                 self.idleCheckTimer.timeout.connect(self._reset_if_idle)
                 self.idleCheckTimer.start()
 
+        # periodically reload products and categories in the background
+        self.catalogLoader = CatalogLoaderThread(self.shoppingBackend, self)
+        self.catalogLoader.catalogLoaded.connect(self.on_catalog_loaded)
+        catalog_refresh_interval = cfg.getint(
+            "backend", "catalog_refresh_interval", fallback=0
+        )
+        if catalog_refresh_interval > 0:
+            self.catalogRefreshTimer = QtCore.QTimer()
+            self.catalogRefreshTimer.setInterval(catalog_refresh_interval * 1000)
+            self.catalogRefreshTimer.timeout.connect(self.startCatalogRefresh)
+            self.catalogRefreshTimer.start()
+
+    def startCatalogRefresh(self):
+        """reload products and categories in the background, see on_catalog_loaded()"""
+        if not self.catalogLoader.isRunning():
+            self.catalogLoader.start()
+
+    def on_catalog_loaded(self, catalog):
+        """the background thread reloaded products and categories"""
+        self.pendingCatalog = catalog
+        self.applyPendingCatalog()
+
+    def applyPendingCatalog(self):
+        """use the reloaded products and categories, but only between orders
+
+        The new catalog is not used while there is an open cart, a search or a
+        dialog. In this case, it is tried again when the cart is empty (see updateOrder()).
+        The current category stays selected if it still exists.
+        """
+        if self.pendingCatalog is None:
+            return
+        if (
+            self.shoppingBackend.get_current_order() is not None
+            or self.stackedWidget.currentIndex() != 0
+            or QtWidgets.QApplication.activeModalWidget() is not None
+            or self.searchScheduler.is_busy()
+        ):
+            return
+        logging.info("using reloaded products and categories")
+        self.shoppingBackend.set_catalog(self.pendingCatalog)
+        self.pendingCatalog = None
+        self.searchScheduler.reset()
+        if self.shoppingBackend.category_exists(self.current_category):
+            # stay in the current category, but show its new contents
+            self.updateProductsAndCategories()
+        else:
+            self.on_start_clicked()
+
     def askUser(self, question):
         """ask the user a question and return whether she agreed."""
         reply = QtWidgets.QMessageBox.question(
@@ -502,39 +587,7 @@ class Kassenterminal(Ui_Kassenterminal, QtWidgets.QMainWindow):
         font.setBold(len(category_path) == 0)
         self.pushButton_start.setFont(font)
 
-        prod_model = QtGui.QStandardItemModel(len(products), 5)
-        for i, p in enumerate(products):
-            prod_id = QtGui.QStandardItem(str(p.prod_id))
-            prod_id.setData(p.prod_id)
-            # prod_id.setTextAlignment(QtCore.Qt.AlignRight | QtCore.Qt.AlignVCenter)
-            light_font = QtGui.QFont()
-            light_font.setPointSize(10)
-            prod_id.setFont(light_font)
-            prod_model.setItem(i, 0, prod_id)
-
-            name = QtGui.QStandardItem(p.name)
-            prod_model.setItem(i, 1, name)
-
-            loc = QtGui.QStandardItem()
-            loc.setText(p.location)
-            prod_model.setItem(i, 2, loc)
-
-            uos = QtGui.QStandardItem(p.unit)
-            prod_model.setItem(i, 3, uos)
-
-            price = QtGui.QStandardItem(self.shoppingBackend.format_money(p.price))
-            prod_model.setItem(i, 4, price)
-
-        prod_model.setHorizontalHeaderItem(0, QtGui.QStandardItem("Nr"))
-        prod_model.setHorizontalHeaderItem(1, QtGui.QStandardItem("Artikel"))
-        prod_model.setHorizontalHeaderItem(2, QtGui.QStandardItem("Lagerort"))
-        prod_model.setHorizontalHeaderItem(3, QtGui.QStandardItem("Einheit"))
-        prod_model.setHorizontalHeaderItem(4, QtGui.QStandardItem("Preis"))
-
-        self.table_products.setModel(prod_model)
-        # adjust height: large enough for precise touching, chosen such that the last item is "half cut off" to make it obvious that you need to scroll further
-        for i in range(len(products)):
-            self.table_products.setRowHeight(i, 42)
+        self.productModel.set_products(products)
 
         # Change column width to useful values
         # needs to be delayed so that resize events for the scrollbar happens first, otherwise it reports a scrollbar width of 100px at the very first call
@@ -578,10 +631,9 @@ class Kassenterminal(Ui_Kassenterminal, QtWidgets.QMainWindow):
         # Retrieve selected product from table
         idx = self.table_products.currentIndex()
         row = idx.row()
-        model = idx.model()
-        if model is None:
+        if not idx.isValid():
             return
-        prod_id = model.item(row, 0).data()
+        prod_id = self.productModel.product_id(row)
 
         # Add selected product to table
         self.addOrderLine(prod_id)
@@ -672,8 +724,7 @@ class Kassenterminal(Ui_Kassenterminal, QtWidgets.QMainWindow):
     def getSelectedOrderLineId(self):
         order_idx = self.table_order.currentIndex()
         if order_idx.model() and order_idx.isValid():
-            order_line_id = order_idx.model().item(order_idx.row(), 0).data()
-            return order_line_id
+            return order_idx.model().order_line_id(order_idx.row())
         else:
             return None
 
@@ -762,6 +813,7 @@ class Kassenterminal(Ui_Kassenterminal, QtWidgets.QMainWindow):
         """clear quantity textbox, start entering PLU. This is called e.g. after quantity-entry is finished"""
         # Change to PLU mode by deselecting the order
         self.table_order.setCurrentIndex(QtCore.QModelIndex())
+        self.table_order.clearSelection()
         self.lineEdit.setText("")
         self.label_unit.setText("PLU / Artikelnummer:")
         self.pushButton_decimal_point.setEnabled(False)
@@ -804,11 +856,12 @@ class Kassenterminal(Ui_Kassenterminal, QtWidgets.QMainWindow):
 
         # Currently no open cart
         if self.shoppingBackend.get_current_order() is None:
-            self.table_order.setModel(QtGui.QStandardItemModel(0, 0))
+            self.table_order.clear_cart()
             self.summe.setText("0,00 €")
             self.pushButton_payup.setEnabled(False)
             self.pushButton_clearCart.setEnabled(False)
             self.start_plu_entry()
+            self.applyPendingCatalog()
             return
 
         # TODO get_orders() ... and switch between tabs
@@ -856,15 +909,27 @@ class Kassenterminal(Ui_Kassenterminal, QtWidgets.QMainWindow):
 
     # list searched items in product tree
     def searchItems(self, preview=False):
+        """search for the text in lineEdit_Suche
+
+        :param preview: only update the results while the user is typing. The
+            search is delayed and runs in the background, see SearchScheduler.
+            Otherwise, search immediately and leave the search view.
+        """
         searchstr = str(self.lineEdit_Suche.text())
-        (categories, products) = self.shoppingBackend.search_from_text(searchstr)
-        self.updateProductsAndCategories(categories, products, "Suchergebnisse")
+        if preview:
+            self.searchScheduler.schedule(searchstr)
+            return
+        self.showSearchResults(self.searchScheduler.search_now(searchstr))
+        self.leaveSearch(keepResultsVisible=True)
 
-        if not preview:
-            self.leaveSearch(keepResultsVisible=True)
+    def showSearchResults(self, results):
+        """show search results (categories, products)"""
+        (categories, products) = results
+        self.updateProductsAndCategories(categories, products, "Suchergebnisse")
 
     def leaveSearch(self, keepResultsVisible=False):
         self.lineEdit_Suche.clear()
+        self.searchScheduler.reset()
         if self.stackedWidget.currentIndex() != 0:
             # after search set view from keyboard to basket
             self.stackedWidget.setCurrentIndex(0)
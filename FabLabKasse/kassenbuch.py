@@ -43,6 +43,8 @@ import sys
 import os
 import random
 import doctest
+import contextlib
+import collections.abc
 from typing import Optional
 
 import locale
@@ -65,6 +67,18 @@ from FabLabKasse import scriptHelper
 # format for serializing the date to SQLite
 DATE_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
 
+# schema version (PRAGMA user_version) from which on the monetary TEXT columns
+# have additional integer columns, see Kasse.migrate_to_integer_cents()
+SCHEMA_VERSION_INTEGER_CENTS = 1
+
+# number of decimal places of the fixed-point columns position.anzahl_micro
+# and position.einzelpreis_micro
+FIXED_POINT_PLACES = 6
+
+# maximum number of ids in one "WHERE ... IN (...)" query
+# (old SQLite versions allow at most 999 parameters per statement)
+BULK_QUERY_CHUNK_SIZE = 500
+
 
 def date2str(date: datetime) -> str:
     """
@@ -81,6 +95,118 @@ def str2date(datestr: str) -> datetime:
     return datetime.strptime(datestr, DATE_FORMAT)
 
 
+def check_betrag(betrag):
+    """
+    Check an amount of money before it is booked
+
+    This is the rule for all amounts of money in ``buchung`` and
+    ``kundenbuchung``: new amounts must be whole cents. Databases of older
+    versions may contain amounts with more decimal places, therefore all sums
+    of stored amounts (``kontostand``, ``kundensaldo``,
+    :meth:`Kasse.account_totals`) are calculated and stored as exact decimals
+    and never rely on this rule.
+
+    :return: the unchanged amount
+    :raises ValueError: if the amount is not a Decimal (or int) or not a multiple of 0.01
+
+    >>> check_betrag(Decimal('-12.34'))
+    Decimal('-12.34')
+    >>> check_betrag(Decimal('1.005'))
+    Traceback (most recent call last):
+        ...
+    ValueError: amount must be a multiple of 0.01, got 1.005
+    """
+    if not isinstance(betrag, (Decimal, int)) or isinstance(betrag, bool):
+        raise ValueError(f"amount must be Decimal, got {betrag!r}")
+    if not Decimal(betrag).is_finite() or decimal2fixedpoint(betrag, 2) is None:
+        raise ValueError(f"amount must be a multiple of 0.01, got {betrag}")
+    return betrag
+
+
+def decimal2str(value: Decimal) -> str:
+    """
+    Serialize an exact sum of money for storing in SQLite DB (without exponent)
+
+    >>> decimal2str(Decimal(0).scaleb(-2))
+    '0.00'
+    """
+    return format(value, "f")
+
+
+def decimal_cmp(a, b) -> int:
+    """
+    Compare two numbers exactly as Decimal, e.g. TEXT amounts in SQL
+
+    Registered as SQL function ``decimal_cmp(a, b)`` by :class:`Kasse`.
+
+    :return: -1, 0 or 1 if ``a`` is less than, equal to or greater than ``b``
+
+    >>> decimal_cmp('-0.30000000000000001', '-0.3')
+    -1
+    >>> decimal_cmp('0.50', Decimal('0.5'))
+    0
+    """
+    return int(Decimal(a).compare(Decimal(b)))
+
+
+def cents2decimal(cents: int) -> Decimal:
+    """
+    Convert integer cents to an amount of money
+
+    >>> cents2decimal(-1234)
+    Decimal('-12.34')
+    """
+    return Decimal(cents).scaleb(-2)
+
+
+def decimal2fixedpoint(value, places: int) -> Optional[int]:
+    """
+    Convert a number to an integer with the given number of implied decimal places
+
+    :return: the integer, or ``None`` if the value cannot be represented exactly
+
+    >>> decimal2fixedpoint(Decimal('0.015'), 6)
+    15000
+    >>> decimal2fixedpoint(Decimal('0.0000001'), 6) is None
+    True
+    """
+    scaled = Decimal(str(value)).scaleb(places)
+    if scaled != scaled.to_integral_value():
+        return None
+    return int(scaled)
+
+
+def last_inserted_ids(cur, count: int) -> range:
+    """
+    Get the ids of the rows inserted by the last ``executemany()`` INSERT
+
+    The ids are consecutive because the table uses AUTOINCREMENT and no other
+    connection can write while the statement holds the write lock.
+
+    :type cur: sqlite3.Cursor
+    """
+    last_id = cur.execute("SELECT last_insert_rowid()").fetchone()[0]
+    return range(last_id - count + 1, last_id + 1)
+
+
+def has_integer_cent_columns(cur) -> bool:
+    """
+    Check if the database has the integer columns that are added by
+    :meth:`Kasse.migrate_to_integer_cents`
+
+    For connections opened by :class:`Kasse`, the value that was determined
+    when opening the database is used, other connections are queried.
+
+    :type cur: sqlite3.Cursor
+    """
+    cached = getattr(cur.connection, "integer_cent_columns", None)
+    if cached is not None:
+        return cached
+    return (
+        cur.execute("PRAGMA user_version").fetchone()[0] >= SCHEMA_VERSION_INTEGER_CENTS
+    )
+
+
 def moneyfmt(value, places=2, curr="", sep=".", dp=",", pos="", neg="-", trailneg=""):
     """Convert Decimal to a money formatted string.
     ::
@@ -142,6 +268,57 @@ class NoDataFound(Exception):
     pass
 
 
+class Position(collections.abc.MutableMapping):
+    """one position of a Rechnung
+
+    Behaves like a dict with fixed keys (``pos["anzahl"]``, ``"{anzahl}".format(**pos)``),
+    but needs less memory. The fields are also available as attributes.
+    """
+
+    __slots__ = [
+        "id",
+        "rechnung",
+        "anzahl",
+        "einheit",
+        "artikel",
+        "einzelpreis",
+        "produkt_ref",
+    ]
+
+    def __init__(
+        self, id, rechnung, anzahl, einheit, artikel, einzelpreis, produkt_ref
+    ):
+        self.id = id
+        self.rechnung = rechnung
+        self.anzahl = anzahl
+        self.einheit = einheit
+        self.artikel = artikel
+        self.einzelpreis = einzelpreis
+        self.produkt_ref = produkt_ref
+
+    def __getitem__(self, key):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __delitem__(self, key):
+        raise TypeError("fields of a Position cannot be deleted")
+
+    def __iter__(self):
+        return iter(self.__slots__)
+
+    def __len__(self):
+        return len(self.__slots__)
+
+    def __repr__(self):
+        return "Position({0})".format(dict(self))
+
+
 class Rechnung(object):
     __slots__ = ["id", "datum", "positionen"]
 
@@ -167,15 +344,15 @@ class Rechnung(object):
         self, artikel, einzelpreis, anzahl=Decimal(1), einheit="", produkt_ref=None
     ):
         self.positionen.append(
-            {
-                "id": None,
-                "rechnung": None,
-                "anzahl": Decimal(anzahl),
-                "einheit": einheit,
-                "artikel": artikel,
-                "einzelpreis": Decimal(einzelpreis),
-                "produkt_ref": produkt_ref,
-            }
+            Position(
+                id=None,
+                rechnung=None,
+                anzahl=Decimal(anzahl),
+                einheit=einheit,
+                artikel=artikel,
+                einzelpreis=Decimal(einzelpreis),
+                produkt_ref=produkt_ref,
+            )
         )
 
     def summe_position(self, pos):
@@ -193,23 +370,26 @@ class Rechnung(object):
 
         return s
 
+    @staticmethod
+    def _position_from_row(row):
+        """convert a row of the ``position`` table to a Position"""
+        return Position(
+            id=row[0],
+            rechnung=row[1],
+            anzahl=Decimal(row[2]),
+            einheit=str(row[3]),
+            artikel=str(row[4]),
+            einzelpreis=Decimal(row[5]),
+            produkt_ref=row[6],
+        )
+
     def _load_positionen(self, cur):
         cur.execute(
             "SELECT id, rechnung, anzahl, einheit, artikel, einzelpreis, produkt_ref FROM position WHERE rechnung=?",
             (self.id,),
         )
         for row in cur:
-            self.positionen.append(
-                {
-                    "id": row[0],
-                    "rechnung": row[1],
-                    "anzahl": Decimal(row[2]),
-                    "einheit": str(row[3]),
-                    "artikel": str(row[4]),
-                    "einzelpreis": Decimal(row[5]),
-                    "produkt_ref": row[6],
-                }
-            )
+            self.positionen.append(self._position_from_row(row))
 
         self.positionen.sort(key=lambda p: p["id"])
 
@@ -230,25 +410,80 @@ class Rechnung(object):
         b._load_positionen(cur)
         return b
 
+    @classmethod
+    def load_from_rows(cls, rows, cur):
+        """
+        load several invoices at once
+
+        The positions of all invoices are fetched with a few
+        ``WHERE rechnung IN (...)`` queries instead of one query per invoice.
+
+        :param rows: rows (id, datum) of the ``rechnung`` table
+        :param cur: sqlite cursor to database
+        :type cur: sqlite3.Cursor
+        :return: invoices in the same order as ``rows``
+        :rtype: list[Rechnung]
+        """
+        rechnungen = {}
+        for row in rows:
+            rechnungen[row[0]] = cls(id=row[0], datum=str2date(row[1]))
+
+        ids = list(rechnungen.keys())
+        for i in range(0, len(ids), BULK_QUERY_CHUNK_SIZE):
+            chunk = ids[i : i + BULK_QUERY_CHUNK_SIZE]
+            cur.execute(
+                "SELECT id, rechnung, anzahl, einheit, artikel, einzelpreis, produkt_ref "
+                + "FROM position WHERE rechnung IN ({0})".format(
+                    ", ".join("?" * len(chunk))
+                ),
+                chunk,
+            )
+            for row in cur:
+                rechnungen[row[1]].positionen.append(cls._position_from_row(row))
+
+        for r in rechnungen.values():
+            r.positionen.sort(key=lambda p: p["id"])
+        return list(rechnungen.values())
+
     def store(self, cur):
+        integer_columns = has_integer_cent_columns(cur)
         cur.execute("INSERT INTO rechnung (datum) VALUES (?)", (date2str(self.datum),))
         self.id = cur.lastrowid
+        if not self.positionen:
+            return
 
+        values = []
         for pos in self.positionen:
             pos["rechnung"] = self.id
-            cur.execute(
+            row = (
+                pos["rechnung"],
+                str(pos["anzahl"]),
+                pos["einheit"],
+                pos["artikel"],
+                str(pos["einzelpreis"]),
+                pos["produkt_ref"],
+            )
+            if integer_columns:
+                row += (
+                    decimal2fixedpoint(pos["anzahl"], FIXED_POINT_PLACES),
+                    decimal2fixedpoint(pos["einzelpreis"], FIXED_POINT_PLACES),
+                )
+            values.append(row)
+
+        if integer_columns:
+            query = (
                 "INSERT INTO position (rechnung, anzahl, einheit, artikel, einzelpreis, "
-                + "produkt_ref) VALUES (?, ?, ?, ?, ?, ?)",
-                (
-                    pos["rechnung"],
-                    str(pos["anzahl"]),
-                    pos["einheit"],
-                    pos["artikel"],
-                    str(pos["einzelpreis"]),
-                    pos["produkt_ref"],
-                ),
+                + "produkt_ref, anzahl_micro, einzelpreis_micro) "
+                + "VALUES (?, ?, ?, ?, ?, ?, ?, ?)"
             )
-            pos["id"] = cur.lastrowid
+        else:
+            query = (
+                "INSERT INTO position (rechnung, anzahl, einheit, artikel, einzelpreis, "
+                + "produkt_ref) VALUES (?, ?, ?, ?, ?, ?)"
+            )
+        cur.executemany(query, values)
+        for pos, pos_id in zip(self.positionen, last_inserted_ids(cur, len(values))):
+            pos["id"] = pos_id
 
     def receipt(self, header="", footer="", export=False):
         r = ""
@@ -375,18 +610,40 @@ class Buchung(object):
         return b
 
     def _store(self, cur):
-        cur.execute(
-            "INSERT INTO buchung (datum, konto, rechnung, betrag, kommentar) VALUES "
-            + "(?, ?, ?, ?, ?)",
-            (
-                date2str(self.datum),
-                self.konto,
-                self.rechnung,
-                str(self.betrag),
-                self.kommentar,
-            ),
-        )
-        self.id = cur.lastrowid
+        Buchung._store_many([self], cur)
+
+    @staticmethod
+    def _store_many(buchungen, cur):
+        """insert several bookings with one prepared statement"""
+        if not buchungen:
+            return
+        integer_columns = has_integer_cent_columns(cur)
+        values = []
+        for b in buchungen:
+            row = (
+                date2str(b.datum),
+                b.konto,
+                b.rechnung,
+                str(b.betrag),
+                b.kommentar,
+            )
+            if integer_columns:
+                row += (decimal2fixedpoint(b.betrag, 2),)
+            values.append(row)
+
+        if integer_columns:
+            query = (
+                "INSERT INTO buchung (datum, konto, rechnung, betrag, kommentar, "
+                + "betrag_cent) VALUES (?, ?, ?, ?, ?, ?)"
+            )
+        else:
+            query = (
+                "INSERT INTO buchung (datum, konto, rechnung, betrag, kommentar) VALUES "
+                + "(?, ?, ?, ?, ?)"
+            )
+        cur.executemany(query, values)
+        for b, buchung_id in zip(buchungen, last_inserted_ids(cur, len(values))):
+            b.id = buchung_id
 
     @property
     def beschreibung(self):
@@ -435,13 +692,80 @@ class Buchung(object):
         return s.__repr__()
 
 
+class BuchungTotalsAggregate(object):
+    """
+    SQLite aggregate ``buchung_totals(betrag)`` for the exact HABEN, SOLL and
+    SALDO of the TEXT amounts of a group of bookings
+
+    Every amount is converted to Decimal only once and summed exactly, so
+    that amounts of older databases that are not whole cents are supported
+    as well.
+
+    An aggregate returns a single value, so the result is HABEN, SOLL and
+    SALDO as decimal TEXT separated by spaces, see :meth:`parse`.
+    """
+
+    def __init__(self):
+        self.haben = cents2decimal(0)
+        self.soll = cents2decimal(0)
+
+    def step(self, betrag):
+        betrag = Decimal(betrag)
+        if betrag > 0:
+            self.haben += betrag
+        elif betrag < 0:
+            self.soll -= betrag
+
+    def finalize(self):
+        return " ".join(
+            decimal2str(value)
+            for value in (self.haben, self.soll, self.haben - self.soll)
+        )
+
+    @staticmethod
+    def parse(result):
+        """
+        convert the result of the aggregate to ``(haben, soll, saldo)``
+
+        >>> BuchungTotalsAggregate.parse("3.505 0.00 3.505")
+        (Decimal('3.505'), Decimal('0.00'), Decimal('3.505'))
+        """
+        return tuple(Decimal(value) for value in result.split(" "))
+
+
+class KasseConnection(sqlite3.Connection):
+    """database connection of a :class:`Kasse`"""
+
+    # does the schema have the integer columns, see has_integer_cent_columns()
+    integer_cent_columns = None
+
+
 class Kasse(object):
-    def __init__(self, sqlite_file=":memory:"):
-        self.con = sqlite3.connect(sqlite_file)
+    def __init__(self, sqlite_file=":memory:", cfg=None):
+        """
+        open (and if necessary create) the database
+
+        :param sqlite_file: path to the database
+        :param cfg: config from :func:`FabLabKasse.scriptHelper.getConfig`, used for
+                    the connection settings (see :func:`FabLabKasse.scriptHelper.configureDB`).
+                    If None, the SQLite defaults are used.
+        """
+        self.con = sqlite3.connect(sqlite_file, factory=KasseConnection)
+        if cfg is not None:
+            scriptHelper.configureDB(self.con, cfg)
         self.cur = self.con.cursor()
         self.con.text_factory = str
+        # nesting level of transaction()
+        self._transaction_depth = 0
+        # exact sums of amounts in SQL, see _buchung_totals()
+        self.con.create_aggregate("buchung_totals", 1, BuchungTotalsAggregate)
+        self.con.create_function("decimal_cmp", 2, decimal_cmp, deterministic=True)
 
         cur = self.cur
+        # tables that are calculated from other tables and need to be filled
+        # when they are created in an existing database
+        kontostand_exists = self._table_exists("kontostand")
+        kundensaldo_exists = self._table_exists("kundensaldo")
         cur.execute(
             """CREATE TABLE IF NOT EXISTS buchung(
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -514,6 +838,22 @@ class Kasse(object):
             rechnung INT,
             betrag)"""
         )
+        # account balance checkpoints, see rebuild_kontostand()
+        cur.execute(
+            """CREATE TABLE IF NOT EXISTS kontostand(
+            konto NOT NULL,
+            tag TEXT NOT NULL,
+            haben TEXT NOT NULL,
+            soll TEXT NOT NULL,
+            saldo TEXT NOT NULL,
+            PRIMARY KEY (konto, tag))"""
+        )
+        # client balances, see rebuild_kundensaldo()
+        cur.execute(
+            """CREATE TABLE IF NOT EXISTS kundensaldo(
+            kunde INTEGER PRIMARY KEY,
+            summe TEXT NOT NULL)"""
+        )
 
         # search indexes for faster execution
         cur.execute("CREATE INDEX IF NOT EXISTS buchungDateIndex ON buchung(datum)")
@@ -536,23 +876,47 @@ class Kasse(object):
             "CREATE INDEX IF NOT EXISTS statistikRechnungIndex ON statistik(rechnung)"
         )
 
+        # checked only once, the schema is only changed by migrate_to_integer_cents().
+        # (The rebuilds below already use it.)
+        self.con.integer_cent_columns = (
+            self.schema_version >= SCHEMA_VERSION_INTEGER_CENTS
+        )
+
+        if not kontostand_exists:
+            # database was created with an older version of this file
+            self.rebuild_kontostand()
+        if not kundensaldo_exists:
+            self.rebuild_kundensaldo()
+
+    def _table_exists(self, name):
+        return (
+            self.cur.execute(
+                "SELECT name FROM sqlite_master WHERE type='table' AND name=?", (name,)
+            ).fetchone()
+            is not None
+        )
+
     @staticmethod
-    def _date_query_generator(from_table=None, from_date=None, until_date=None):
+    def _date_query_generator(
+        from_table=None, from_date=None, until_date=None, columns="id"
+    ):
         """
         returns a string for a SQL query to rechnung or buchung
 
         :param from_table: which table should be queried
         :param from_date: datetime start date (included)
         :param until_date: datetime end date (not included)
+        :param columns: comma-separated list of columns to select
         :type from_date: datetime.datetime | None
         :type until_date: datetime.datetime | None
+        :type columns: str
         :return: query string
         """
         known_tables = ["buchung", "rechnung"]
         if from_table not in known_tables:
             raise NotImplementedError(f"unimplemented table {from_table}")
 
-        query = f"SELECT id FROM {from_table}"
+        query = f"SELECT {columns} FROM {from_table}"
         if from_date and until_date:
             query = (
                 query
@@ -566,6 +930,116 @@ class Kasse(object):
         query = query + " ORDER BY datum ASC"
         return query
 
+    @property
+    def schema_version(self):
+        """version of the database schema (``PRAGMA user_version``)
+
+        see :data:`SCHEMA_VERSION_INTEGER_CENTS`
+        """
+        return self.cur.execute("PRAGMA user_version").fetchone()[0]
+
+    def migrate_to_integer_cents(self, batch_size=1000):
+        """
+        add integer columns for the monetary values and fill them
+
+        The TEXT columns are kept (and still written) so that older versions and
+        external scripts continue to work. The new columns are:
+
+        - ``buchung.betrag_cent``, ``kundenbuchung.betrag_cent``: amount in cents
+        - ``position.anzahl_micro``, ``position.einzelpreis_micro``: fixed-point
+          values with :data:`FIXED_POINT_PLACES` decimal places
+
+        A value that cannot be represented exactly stays ``NULL``, readers must
+        then fall back to the TEXT column.
+
+        The migration can be run while the database is in use: the schema change
+        is one short transaction, from then on new rows are written with the
+        integer columns, and the existing rows are filled in batches of
+        ``batch_size`` with a commit after each batch. It can safely be
+        restarted if it was interrupted.
+
+        Other programs that already have the database open keep writing rows
+        without the integer columns until they are restarted, because the
+        schema version is only checked when opening the database. Running
+        the migration again afterwards fills these rows as well.
+
+        :return: number of existing values that could not be converted exactly
+        :rtype: int
+        """
+        columns = {
+            "buchung": [("betrag_cent", "betrag", 2)],
+            "kundenbuchung": [("betrag_cent", "betrag", 2)],
+            "position": [
+                ("anzahl_micro", "anzahl", FIXED_POINT_PLACES),
+                ("einzelpreis_micro", "einzelpreis", FIXED_POINT_PLACES),
+            ],
+        }
+
+        for table, table_columns in columns.items():
+            existing = [
+                row[1] for row in self.cur.execute(f"PRAGMA table_info({table})")
+            ]
+            for column, _, _ in table_columns:
+                if column not in existing:
+                    self.cur.execute(f"ALTER TABLE {table} ADD COLUMN {column} INT")
+        self.cur.execute(
+            "CREATE INDEX IF NOT EXISTS buchungKontoBetragIndex "
+            + "ON buchung(konto, betrag_cent)"
+        )
+        if self.schema_version < SCHEMA_VERSION_INTEGER_CENTS:
+            self.cur.execute(f"PRAGMA user_version = {SCHEMA_VERSION_INTEGER_CENTS}")
+        self.con.commit()
+        self.con.integer_cent_columns = True
+
+        not_convertible = 0
+        for table, table_columns in columns.items():
+            for column, text_column, places in table_columns:
+                last_id = 0
+                while True:
+                    rows = self.cur.execute(
+                        f"SELECT id, {text_column} FROM {table} "
+                        + f"WHERE id > ? AND {column} IS NULL ORDER BY id LIMIT ?",
+                        (last_id, batch_size),
+                    ).fetchall()
+                    if not rows:
+                        break
+                    last_id = rows[-1][0]
+                    values = []
+                    for row_id, text_value in rows:
+                        value = decimal2fixedpoint(text_value, places)
+                        if value is None:
+                            not_convertible += 1
+                        else:
+                            values.append((value, row_id))
+                    self.cur.executemany(
+                        f"UPDATE {table} SET {column}=? WHERE id=?", values
+                    )
+                    self.con.commit()
+        return not_convertible
+
+    def _iter_rows(self, query, params=(), batch_size=1000):
+        """
+        execute a query on a separate cursor and yield the resulting rows
+
+        The rows are fetched in batches of ``batch_size`` with ``fetchmany()``,
+        so that large results are never completely held in memory.
+
+        :param query: SQL query string
+        :param params: query parameters
+        :param batch_size: number of rows fetched at once
+        :type batch_size: int
+        """
+        cur = self.con.cursor()
+        try:
+            cur.execute(query, params)
+            while True:
+                rows = cur.fetchmany(batch_size)
+                if not rows:
+                    return
+                yield rows
+        finally:
+            cur.close()
+
     @property
     def buchungen(self):
         return self.get_buchungen()
@@ -581,16 +1055,31 @@ class Kasse(object):
         :type from_date: datetime.datetime | None
         :type until_date: datetime.datetime | None
         """
-        buchungen = []
+        return list(self.iter_buchungen(from_date, until_date))
 
+    def iter_buchungen(self, from_date=None, until_date=None, batch_size=1000):
+        """
+        iterate over the accounting records between the given dates.
+
+        Like :meth:`get_buchungen`, but the records are loaded on demand in
+        batches of ``batch_size``, so that memory usage does not grow with the
+        size of the database.
+
+        :param from_date: see :meth:`get_buchungen`
+        :param until_date: see :meth:`get_buchungen`
+        :param batch_size: number of records fetched from the database at once
+        :type batch_size: int
+        :rtype: Iterator[Buchung]
+        """
         query = Kasse._date_query_generator(
-            from_table="buchung", from_date=from_date, until_date=until_date
+            from_table="buchung",
+            from_date=from_date,
+            until_date=until_date,
+            columns="id, datum, konto, rechnung, betrag, kommentar",
         )
-        self.cur.execute(query)
-        for row in self.cur.fetchall():
-            buchungen.append(Buchung.load_from_id(row[0], self.cur))
-
-        return buchungen
+        for rows in self._iter_rows(query, batch_size=batch_size):
+            for row in rows:
+                yield Buchung.load_from_row(row)
 
     @property
     def rechnungen(self):
@@ -611,25 +1100,137 @@ class Kasse(object):
         :type from_date: datetime.datetime | None
         :type until_date: datetime.datetime | None
         """
-        rechnungen = []
+        return list(self.iter_rechnungen(from_date, until_date))
 
+    def iter_rechnungen(
+        self,
+        from_date: Optional[datetime] = None,
+        until_date: Optional[datetime] = None,
+        batch_size: int = 1000,
+    ):
+        """
+        iterate over the invoices between the given dates.
+
+        Like :meth:`get_rechnungen`, but the invoices (including their
+        positions) are loaded on demand in batches of ``batch_size``.
+
+        :param from_date: see :meth:`get_rechnungen`
+        :param until_date: see :meth:`get_rechnungen`
+        :param batch_size: number of invoices fetched from the database at once
+        :type batch_size: int
+        :rtype: Iterator[Rechnung]
+        """
         query = Kasse._date_query_generator(
-            from_table="rechnung", from_date=from_date, until_date=until_date
+            from_table="rechnung",
+            from_date=from_date,
+            until_date=until_date,
+            columns="id, datum",
         )
-        self.cur.execute(query)
-        for row in self.cur.fetchall():
-            rechnungen.append(Rechnung.load_from_id(row[0], self.cur))
-
-        return rechnungen
+        position_cur = self.con.cursor()
+        try:
+            for rows in self._iter_rows(query, batch_size=batch_size):
+                for rechnung in Rechnung.load_from_rows(rows, position_cur):
+                    yield rechnung
+        finally:
+            position_cur.close()
 
     @property
     def kunden(self):
-        kunden = []
+        return list(self.iter_kunden())
+
+    def iter_kunden(self, batch_size=1000, load_buchungen=True):
+        """
+        iterate over all clients, loading them on demand in batches of ``batch_size``
 
-        self.cur.execute("SELECT id FROM kunde")
-        for row in self.cur.fetchall():
-            kunden.append(Kunde.load_from_id(row[0], self.cur))
+        :param load_buchungen: load the transactions of each client,
+                               see :meth:`Kunde.load_from_row`
+        :rtype: Iterator[Kunde]
+        """
+        cur = self.con.cursor()
+        try:
+            for rows in self._iter_rows(
+                "SELECT id, name, pin, schuldengrenze, email, telefon, adresse, "
+                + "kommentar FROM kunde ORDER BY id ASC",
+                batch_size=batch_size,
+            ):
+                for row in rows:
+                    yield Kunde.load_from_row(row, cur, load_buchungen)
+        finally:
+            cur.close()
+
+    def list_kunden(
+        self, inactive_days=None, max_balance=None, remove_zeros=False, now=None
+    ):
+        """
+        list clients with their balance and the dates of their last transactions
+
+        Everything is fetched with one SQL query, the transactions of the
+        clients are not loaded (see ``load_buchungen`` in
+        :meth:`Kunde.load_from_row`). The filters are applied in the query, the
+        balances are compared exactly with :func:`decimal_cmp`.
+
+        If ``inactive_days`` and/or ``max_balance`` is given, only clients
+        matching at least one of these filters are returned.
+
+        :param inactive_days: clients whose last charge is at least this many days ago
+        :param max_balance: clients whose balance is below this value
+        :param remove_zeros: exclude clients whose balance is (nearly) zero
+        :param now: reference time for ``inactive_days``, default: now
+        :type inactive_days: int | None
+        :type max_balance: Decimal | None
+        :type now: datetime.datetime | None
+        :return: list of (client, date of last payment, date of last charge), sorted
+                 by client id. The dates are ``None`` if there was no such transaction.
+        :rtype: list[tuple[Kunde, datetime.datetime | None, datetime.datetime | None]]
+        """
+        # clients without transactions have no row in kundensaldo
+        summe = "COALESCE(kundensaldo.summe, '0')"
+        # CAST(... AS REAL) is only used for the sign of a transaction,
+        # the balance is compared exactly
+        query = (
+            "SELECT kunde.id, kunde.name, kunde.pin, kunde.schuldengrenze, kunde.email, "
+            "kunde.telefon, kunde.adresse, kunde.kommentar, "
+            f"{summe}, "
+            "letzte.zahlung, letzte.belastung FROM kunde "
+            "LEFT JOIN kundensaldo ON kundensaldo.kunde = kunde.id "
+            "LEFT JOIN (SELECT kunde, "
+            "MAX(CASE WHEN CAST(betrag AS REAL) > 0 THEN datum END) AS zahlung, "
+            "MAX(CASE WHEN CAST(betrag AS REAL) < 0 THEN datum END) AS belastung "
+            "FROM kundenbuchung GROUP BY kunde) AS letzte ON letzte.kunde = kunde.id"
+        )
+        filters = []
+        params = []
+        if inactive_days is not None:
+            filters.append("letzte.belastung <= ?")
+            params.append(
+                date2str((now or datetime.now()) - timedelta(days=inactive_days))
+            )
+        if max_balance is not None:
+            filters.append(f"decimal_cmp({summe}, ?) < 0")
+            params.append(str(max_balance))
+        conditions = []
+        if filters:
+            conditions.append("(" + " OR ".join(filters) + ")")
+        if remove_zeros:
+            conditions.append(
+                f"(decimal_cmp({summe}, '0.005') >= 0 "
+                + f"OR decimal_cmp({summe}, '-0.005') <= 0)"
+            )
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY kunde.id ASC"
 
+        kunden = []
+        for row in self.cur.execute(query, params).fetchall():
+            kunde = Kunde._from_row(row)
+            kunde._set_summe(Decimal(row[8]))
+            kunden.append(
+                (
+                    kunde,
+                    str2date(row[9]) if row[9] else None,
+                    str2date(row[10]) if row[10] else None,
+                )
+            )
         return kunden
 
     def buchen(self, buchungen):
@@ -637,10 +1238,7 @@ class Kasse(object):
         konten = []
         daten = set()
         for b in buchungen:
-            assert isinstance(b.betrag, (Decimal, int)), "amount must be Decimal"
-            assert (
-                b.betrag % Decimal("0.01") == 0
-            ), "amount must be a multiple of 0.01 - half cents are not allowed"
+            check_betrag(b.betrag)
             saldo += b.betrag
             konten.append(b.konto)
             daten.add(b.datum)
@@ -653,10 +1251,299 @@ class Kasse(object):
             len(daten) == 1
         ), "Alle Buchungen in einem Buchungsfall muessen das selbe Datum haben."
 
-        for b in buchungen:
-            b._store(self.cur)
+        with self.transaction():
+            Buchung._store_many(buchungen, self.cur)
+            for b in buchungen:
+                self._update_kontostand(b)
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+        context manager that groups several write operations into one transaction
+
+        The database is locked for writing at the start (``BEGIN IMMEDIATE``),
+        committed at the end and rolled back if an exception occurs. Nested
+        calls (e.g. :meth:`buchen` inside a transaction) join the outer
+        transaction. Changes that were not yet committed before the outermost
+        call become part of the transaction.
+
+        Usage::
+
+            with kasse.transaction():
+                rechnung.store(kasse.cur)
+                kasse.buchen([b1, b2])
+        """
+        if self._transaction_depth == 0 and not self.con.in_transaction:
+            self.cur.execute("BEGIN IMMEDIATE")
+        self._transaction_depth += 1
+        try:
+            yield
+        except BaseException:
+            self._transaction_depth -= 1
+            if self._transaction_depth == 0:
+                self.con.rollback()
+            raise
+        self._transaction_depth -= 1
+        if self._transaction_depth == 0:
+            self.con.commit()
+
+    def _update_kontostand(self, buchung):
+        """
+        add a booking to the account balance checkpoints
+
+        Does not commit. Bookings in the past are supported, then all later
+        checkpoints of that account are updated as well.
+        """
+        tag = buchung.datum.strftime("%Y-%m-%d")
+        betrag = Decimal(buchung.betrag)
+
+        if (
+            self.cur.execute(
+                "SELECT 1 FROM kontostand WHERE konto=? AND tag=?",
+                (buchung.konto, tag),
+            ).fetchone()
+            is None
+        ):
+            # new checkpoint, starting with the totals of the previous one
+            previous = self.cur.execute(
+                "SELECT haben, soll, saldo FROM kontostand "
+                + "WHERE konto=? AND tag<? ORDER BY tag DESC LIMIT 1",
+                (buchung.konto, tag),
+            ).fetchone() or ("0", "0", "0")
+            self.cur.execute(
+                "INSERT INTO kontostand (konto, tag, haben, soll, saldo) "
+                + "VALUES (?, ?, ?, ?, ?)",
+                (buchung.konto, tag) + tuple(previous),
+            )
+
+        # the sums are exact decimals, so they are calculated in Python
+        rows = self.cur.execute(
+            "SELECT tag, haben, soll, saldo FROM kontostand WHERE konto=? AND tag>=?",
+            (buchung.konto, tag),
+        ).fetchall()
+        self.cur.executemany(
+            "UPDATE kontostand SET haben=?, soll=?, saldo=? WHERE konto=? AND tag=?",
+            (
+                (
+                    decimal2str(Decimal(haben) + max(betrag, 0)),
+                    decimal2str(Decimal(soll) + max(-betrag, 0)),
+                    decimal2str(Decimal(saldo) + betrag),
+                    buchung.konto,
+                    row_tag,
+                )
+                for row_tag, haben, soll, saldo in rows
+            ),
+        )
+
+    def _calculate_kontostand(self):
+        """
+        calculate the account balance checkpoints from the ``buchung`` table
+
+        :return: {(konto, tag): (haben, soll, saldo)}
+        :rtype: dict[tuple[str, str], tuple[Decimal, Decimal, Decimal]]
+        """
+        totals = {}
+        kontostand = {}
+        # the date format starts with YYYY-MM-DD
+        for (konto, tag), (haben, soll, saldo) in self._buchung_totals(
+            ["konto", "substr(datum, 1, 10)"]
+        ).items():
+            previous = totals.get(konto, (Decimal(0), Decimal(0), Decimal(0)))
+            totals[konto] = (
+                previous[0] + haben,
+                previous[1] + soll,
+                previous[2] + saldo,
+            )
+            kontostand[(konto, tag)] = totals[konto]
+        return kontostand
+
+    def rebuild_kontostand(self):
+        """
+        recreate the account balance checkpoints from the ``buchung`` table
+
+        The table ``kontostand`` contains one row per account and day with
+        bookings. Each row holds the account totals (HABEN, SOLL, SALDO as exact
+        decimal TEXT) including all bookings up to the end of that day, so that
+        :meth:`summary_to_string` does not need to read the whole history.
+        """
+        self.cur.execute("DELETE FROM kontostand")
+        self.cur.executemany(
+            "INSERT INTO kontostand (konto, tag, haben, soll, saldo) "
+            + "VALUES (?, ?, ?, ?, ?)",
+            (
+                key + tuple(decimal2str(value) for value in values)
+                for key, values in self._calculate_kontostand().items()
+            ),
+        )
         self.con.commit()
 
+    def verify_kontostand(self):
+        """
+        check the account balance checkpoints against the ``buchung`` table
+
+        :return: list of error messages, empty if everything is consistent
+        :rtype: list[str]
+        """
+        expected = self._calculate_kontostand()
+        stored = {}
+        for row in self.cur.execute(
+            "SELECT konto, tag, haben, soll, saldo FROM kontostand"
+        ):
+            stored[(row[0], row[1])] = tuple(Decimal(value) for value in row[2:])
+
+        errors = []
+        for key in sorted(set(expected) | set(stored)):
+            if expected.get(key) != stored.get(key):
+                errors.append(
+                    "Konto {0} am {1}: erwartet (HABEN, SOLL, SALDO) = {2}, "
+                    "gespeichert {3}".format(
+                        key[0], key[1], expected.get(key), stored.get(key)
+                    )
+                )
+        return errors
+
+    def account_totals(self, from_date=None, until_date=None):
+        """
+        get the debit/credit totals of all accounts between the given dates.
+
+        The sums are exact, see :meth:`_buchung_totals`.
+
+        :param from_date: start datetime (included), or ``None``
+        :param until_date: end datetime (not included), or ``None``
+        :type from_date: datetime.datetime | None
+        :type until_date: datetime.datetime | None
+        :return: ``{konto: (haben, soll, saldo)}`` sorted by account name,
+                 where HABEN is the sum of positive and SOLL the (positive) sum
+                 of negative bookings
+        :rtype: dict[str, tuple[Decimal, Decimal, Decimal]]
+        """
+        return {
+            konto: values
+            for (konto,), values in self._buchung_totals(
+                ["konto"], from_date, until_date
+            ).items()
+        }
+
+    def _buchung_totals(self, group_by, from_date=None, until_date=None):
+        """
+        get HABEN, SOLL and SALDO of the bookings between the given dates,
+        grouped by the given columns
+
+        The TEXT amounts are summed by one grouped SQL query with the aggregate
+        :class:`BuchungTotalsAggregate`, which also supports amounts with more
+        decimal places (e.g. half cents in databases of older versions). After
+        :meth:`migrate_to_integer_cents`, the integer column is summed by SQL
+        where it is filled, and only the other rows use the aggregate.
+
+        :param group_by: SQL expressions to group by, e.g. ``["konto"]``
+        :type group_by: list[str]
+        :param from_date: start datetime (included), or ``None``
+        :param until_date: end datetime (not included), or ``None``
+        :return: ``{(group values): (haben, soll, saldo)}`` sorted by group
+        :rtype: dict[tuple, tuple[Decimal, Decimal, Decimal]]
+        """
+        groups = ", ".join(group_by)
+        conditions = []
+        params = []
+        if from_date:
+            conditions.append("datum >= ?")
+            params.append(date2str(from_date))
+        if until_date:
+            conditions.append("datum < ?")
+            params.append(date2str(until_date))
+
+        def grouped_query(columns, condition=None):
+            query = f"SELECT {groups}, {columns} FROM buchung"
+            where = conditions + ([condition] if condition else [])
+            if where:
+                query += " WHERE " + " AND ".join(where)
+            return query + f" GROUP BY {groups} ORDER BY {groups}"
+
+        if not self.con.integer_cent_columns:
+            return {
+                tuple(row[:-1]): BuchungTotalsAggregate.parse(row[-1])
+                for row in self.cur.execute(
+                    grouped_query("buchung_totals(betrag)"), params
+                )
+            }
+
+        totals = {}
+        for row in self.cur.execute(
+            grouped_query(
+                "SUM(MAX(betrag_cent, 0)), SUM(MAX(-betrag_cent, 0)), SUM(betrag_cent)",
+                "betrag_cent IS NOT NULL",
+            ),
+            params,
+        ):
+            totals[tuple(row[:-3])] = tuple(cents2decimal(value) for value in row[-3:])
+        for row in self.cur.execute(
+            grouped_query("buchung_totals(betrag)", "betrag_cent IS NULL"), params
+        ):
+            key = tuple(row[:-1])
+            values = BuchungTotalsAggregate.parse(row[-1])
+            if key in totals:
+                values = tuple(x + y for x, y in zip(totals[key], values))
+            totals[key] = values
+        return dict(sorted(totals.items()))
+
+    def _calculate_kundensaldo(self):
+        """
+        calculate the client balances from the ``kundenbuchung`` table
+
+        :return: {kunde: summe}
+        :rtype: dict[int, Decimal]
+        """
+        kundensaldo = {}
+        for rows in self._iter_rows("SELECT kunde, betrag FROM kundenbuchung"):
+            for kunde, betrag in rows:
+                kundensaldo[kunde] = kundensaldo.get(kunde, Decimal(0)) + Decimal(
+                    betrag
+                )
+        return kundensaldo
+
+    def rebuild_kundensaldo(self):
+        """
+        recreate the client balances from the ``kundenbuchung`` table
+
+        The table ``kundensaldo`` contains the sum of all transactions of each
+        client (as exact decimal TEXT, see :func:`check_betrag`), so that
+        listing clients does not need to load all their transactions. It is
+        kept up to date by :meth:`Kundenbuchung.store`.
+        """
+        self.cur.execute("DELETE FROM kundensaldo")
+        self.cur.executemany(
+            "INSERT INTO kundensaldo (kunde, summe) VALUES (?, ?)",
+            (
+                (kunde, decimal2str(summe))
+                for kunde, summe in self._calculate_kundensaldo().items()
+                if kunde is not None
+            ),
+        )
+        self.con.commit()
+
+    def verify_kundensaldo(self):
+        """
+        check the client balances against the ``kundenbuchung`` table
+
+        :return: list of error messages, empty if everything is consistent
+        :rtype: list[str]
+        """
+        expected = self._calculate_kundensaldo()
+        expected.pop(None, None)
+        stored = {}
+        for kunde, summe in self.cur.execute("SELECT kunde, summe FROM kundensaldo"):
+            stored[kunde] = Decimal(summe)
+
+        errors = []
+        for kunde in sorted(set(expected) | set(stored)):
+            if expected.get(kunde, Decimal(0)) != stored.get(kunde, Decimal(0)):
+                errors.append(
+                    "Kunde #{0}: erwartet {1}, gespeichert {2}".format(
+                        kunde, expected.get(kunde), stored.get(kunde)
+                    )
+                )
+        return errors
+
     def to_string(
         self, from_date=None, until_date=None, snapshot_time=None, show_receipts=True
     ):
@@ -700,9 +1587,12 @@ class Kasse(object):
             for r in rechnungen:
                 s += r.to_string() + "\n"
 
-        konto_saldi = {}
-        for b in buchungen:
-            konto_saldi[b.konto] = konto_saldi.get(b.konto, Decimal(0)) + b.betrag
+        konto_saldi = {
+            konto: saldo
+            for konto, (_, _, saldo) in self.account_totals(
+                from_date, filter_until_date
+            ).items()
+        }
 
         s += "\nKonten:\n"
         s += "KONTO               "
@@ -729,29 +1619,46 @@ class Kasse(object):
         string = ""
         date = date or snapshot_time or datetime.now()
 
-        buchungen = self.get_buchungen(from_date=None, until_date=date)
+        last_buchung = self.cur.execute(
+            "SELECT id, datum, konto, rechnung, betrag, kommentar FROM buchung "
+            + "WHERE datum < ? ORDER BY datum DESC, id DESC LIMIT 1",
+            (date2str(date),),
+        ).fetchone()
 
         string += "Kassenstand am {0}:\n".format(date)
-        if not buchungen:
+        if last_buchung is None:
             string += "(noch keine Buchungen an diesem Datum -- 0 EUR)\n"
             return string
         else:
+            last_buchung = Buchung.load_from_row(last_buchung)
             string += (
                 "(letzte darin enthaltene Buchung ist '{title}' vom {end})\n".format(
-                    title=buchungen[-1].beschreibung, end=buchungen[-1].datum
+                    title=last_buchung.beschreibung, end=last_buchung.datum
                 )
             )
 
+        # start with the last checkpoint before the given day ...
+        day_start = datetime(date.year, date.month, date.day)
         konto_haben = {}
         konto_soll = {}
         konto_saldi = {}
-        for b in buchungen:
-            if b.betrag > 0:
-                konto_haben[b.konto] = konto_haben.get(b.konto, Decimal(0)) + b.betrag
-            else:
-                konto_soll[b.konto] = konto_soll.get(b.konto, Decimal(0)) - b.betrag
-
-            konto_saldi[b.konto] = konto_saldi.get(b.konto, Decimal(0)) + b.betrag
+        # (SQLite returns the other columns from the row with the maximum date)
+        for konto, _, haben, soll, saldo in self.cur.execute(
+            "SELECT konto, MAX(tag), haben, soll, saldo FROM kontostand "
+            + "WHERE tag < ? GROUP BY konto ORDER BY konto",
+            (day_start.strftime("%Y-%m-%d"),),
+        ).fetchall():
+            konto_haben[konto] = Decimal(haben)
+            konto_soll[konto] = Decimal(soll)
+            konto_saldi[konto] = Decimal(saldo)
+
+        # ... and add the bookings since then
+        for konto, (haben, soll, saldo) in self.account_totals(
+            from_date=day_start, until_date=date
+        ).items():
+            konto_haben[konto] = konto_haben.get(konto, Decimal(0)) + haben
+            konto_soll[konto] = konto_soll.get(konto, Decimal(0)) + soll
+            konto_saldi[konto] = konto_saldi.get(konto, Decimal(0)) + saldo
 
         string += "{:<16} {:>10} {:>10} {:>10}\n".format(
             "KONTO", "HABEN", "SOLL", "SALDO"
@@ -788,9 +1695,32 @@ class Kunde(object):
         self.kommentar = kommentar
 
         self.buchungen = []
+        # sum of the stored transactions that are not contained in self.buchungen
+        # (non-zero only if the history was not loaded, see load_from_row())
+        self._summe_ohne_buchungen = Decimal(0)
+        self._buchungen_loaded = True
+        # values as stored in the database, None if not yet stored
+        self._stored_values = None
+
+    def _values(self):
+        """values of the database columns, used for detecting modifications"""
+        return (
+            self.name,
+            self.pin,
+            self.schuldengrenze,
+            self.email,
+            self.telefon,
+            self.adresse,
+            self.kommentar,
+        )
+
+    @property
+    def modified(self):
+        """has the client (without its transactions) been modified since it was loaded or stored?"""
+        return self._stored_values != self._values()
 
     @classmethod
-    def load_from_id(cls, id, cur):
+    def load_from_id(cls, id, cur, load_buchungen=True):
         cur.execute(
             "SELECT id, name, pin, schuldengrenze, email, telefon, adresse, kommentar "
             + "FROM kunde WHERE id = ?",
@@ -801,10 +1731,10 @@ class Kunde(object):
         if row is None:
             raise NoDataFound()
 
-        return cls.load_from_row(row, cur)
+        return cls.load_from_row(row, cur, load_buchungen)
 
     @classmethod
-    def load_from_name(cls, name, cur):
+    def load_from_name(cls, name, cur, load_buchungen=True):
         cur.execute(
             "SELECT id, name, pin, schuldengrenze, email, telefon, adresse, kommentar "
             + "FROM kunde WHERE name = ?",
@@ -815,10 +1745,31 @@ class Kunde(object):
         if row is None:
             raise NoDataFound()
 
-        return cls.load_from_row(row, cur)
+        return cls.load_from_row(row, cur, load_buchungen)
 
     @classmethod
-    def load_from_row(cls, row, cur):
+    def load_from_row(cls, row, cur, load_buchungen=True):
+        """
+        create client from a database row
+
+        :param load_buchungen: load all transactions of the client into
+            :attr:`buchungen`. If False, only the balance is loaded from the
+            ``kundensaldo`` table, :attr:`buchungen` then only contains the
+            transactions added afterwards. :attr:`summe` is correct in both
+            cases.
+        """
+        b = cls._from_row(row)
+
+        if load_buchungen:
+            b._load_buchungen(cur)
+        else:
+            b._load_summe(cur)
+
+        return b
+
+    @classmethod
+    def _from_row(cls, row):
+        """create client from a database row without loading transactions or balance"""
         b = cls(
             id=row[0],
             name=row[1],
@@ -829,9 +1780,7 @@ class Kunde(object):
             adresse=row[6],
             kommentar=row[7],
         )
-
-        b._load_buchungen(cur)
-
+        b._stored_values = b._values()
         return b
 
     def store(self, cur) -> None:
@@ -850,7 +1799,7 @@ class Kunde(object):
                 ),
             )
             self.id = cur.lastrowid
-        else:
+        elif self.modified:
             cur.execute(
                 "UPDATE kunde SET name=?, pin=?, schuldengrenze=?, email=?, telefon=?, "
                 + "adresse=?, kommentar=? WHERE id=?",
@@ -865,9 +1814,12 @@ class Kunde(object):
                     self.id,
                 ),
             )
+        self._stored_values = self._values()
 
+        # only new or modified transactions are written
         for b in self.buchungen:
-            b.store(cur)
+            if b.modified:
+                b.store(cur)
 
         return self.id
 
@@ -893,6 +1845,21 @@ class Kunde(object):
 
         for row in cur:
             self.buchungen.append(Kundenbuchung.load_from_row(row))
+        self._summe_ohne_buchungen = Decimal(0)
+        self._buchungen_loaded = True
+
+    def _load_summe(self, cur) -> None:
+        """loads only the balance of a client and discards current transactions"""
+        row = cur.execute(
+            "SELECT summe FROM kundensaldo WHERE kunde=?", (self.id,)
+        ).fetchone()
+        self._set_summe(Decimal(row[0]) if row else Decimal(0))
+
+    def _set_summe(self, summe) -> None:
+        """set the balance of all stored transactions and discard current transactions"""
+        self.buchungen = []
+        self._summe_ohne_buchungen = summe
+        self._buchungen_loaded = False
 
     def add_buchung(self, betrag, rechnung=None, kommentar=None, datum=None):
         self.buchungen.append(
@@ -903,7 +1870,7 @@ class Kunde(object):
 
     @property
     def summe(self):
-        summe = Decimal(0)
+        summe = self._summe_ohne_buchungen
 
         for b in self.buchungen:
             summe += b.betrag
@@ -931,6 +1898,9 @@ class Kunde(object):
         if short:
             return summary
         else:
+            assert (
+                self._buchungen_loaded
+            ), "transactions were not loaded, use load_buchungen=True"
             details = Kundenbuchung.header
             details += "\n".join((b.to_string() for b in self.buchungen))
             details += "\n\n"
@@ -977,6 +1947,8 @@ class Kundenbuchung(object):
         self.rechnung = rechnung
         self.betrag = betrag
         self.kommentar = kommentar
+        # values as stored in the database, None if not yet stored
+        self._stored_values = None
 
         if not rechnung and not kommentar:
             raise ValueError(
@@ -1007,36 +1979,86 @@ class Kundenbuchung(object):
             betrag=Decimal(row[4]),
             kommentar=row[5],
         )
+        b._stored_values = b._values()
         return b
 
+    def _values(self):
+        """values of the database columns, used for detecting modifications"""
+        return (self.datum, self.kunde, self.rechnung, self.betrag, self.kommentar)
+
+    @property
+    def modified(self):
+        """is the transaction new or has it been modified since it was loaded or stored?"""
+        return self._stored_values != self._values()
+
+    @staticmethod
+    def _add_to_kundensaldo(cur, kunde, betrag):
+        """add an amount to the stored balance of a client (without commit)"""
+        if kunde is None:
+            return
+        # write first, so that the database is locked against concurrent updates
+        cur.execute(
+            "INSERT OR IGNORE INTO kundensaldo (kunde, summe) VALUES (?, '0')",
+            (kunde,),
+        )
+        summe = Decimal(
+            cur.execute(
+                "SELECT summe FROM kundensaldo WHERE kunde=?", (kunde,)
+            ).fetchone()[0]
+        )
+        cur.execute(
+            "UPDATE kundensaldo SET summe=? WHERE kunde=?",
+            (decimal2str(summe + Decimal(betrag)), kunde),
+        )
+
     def store(self, cur):
+        """
+        insert or update the transaction and the client balance (without commit)
+
+        :raises ValueError: if a new or changed amount is not whole cents, see :func:`check_betrag`
+        """
+        if self._stored_values is None or self._stored_values[3] != self.betrag:
+            check_betrag(self.betrag)
+        values = (
+            date2str(self.datum),
+            self.kunde,
+            self.rechnung,
+            str(self.betrag),
+            self.kommentar,
+        )
+        if has_integer_cent_columns(cur):
+            values += (decimal2fixedpoint(self.betrag, 2),)
+            betrag_cent_insert = ", betrag_cent) VALUES (?, ?, ?, ?, ?, ?)"
+            betrag_cent_update = ", betrag_cent=?"
+        else:
+            betrag_cent_insert = ") VALUES (?, ?, ?, ?, ?)"
+            betrag_cent_update = ""
+
         if self.id is None:
             cur.execute(
-                "INSERT INTO kundenbuchung (datum, kunde, rechnung, betrag, kommentar) "
-                + "VALUES (?, ?, ?, ?, ?)",
-                (
-                    date2str(self.datum),
-                    self.kunde,
-                    self.rechnung,
-                    str(self.betrag),
-                    self.kommentar,
-                ),
+                "INSERT INTO kundenbuchung (datum, kunde, rechnung, betrag, kommentar"
+                + betrag_cent_insert,
+                values,
             )
             self.id = cur.lastrowid
         else:
             cur.execute(
                 "UPDATE kundenbuchung SET datum=?, kunde=?, rechnung=?, betrag=?, "
-                + "kommentar=? WHERE id=?",
-                (
-                    date2str(self.datum),
-                    self.kunde,
-                    self.rechnung,
-                    str(self.betrag),
-                    self.kommentar,
-                    self.id,
-                ),
+                + "kommentar=?"
+                + betrag_cent_update
+                + " WHERE id=?",
+                values + (self.id,),
             )
 
+        if self._stored_values is None:
+            Kundenbuchung._add_to_kundensaldo(cur, self.kunde, self.betrag)
+        else:
+            stored_kunde, stored_betrag = self._stored_values[1], self._stored_values[3]
+            if (stored_kunde, stored_betrag) != (self.kunde, self.betrag):
+                Kundenbuchung._add_to_kundensaldo(cur, stored_kunde, -stored_betrag)
+                Kundenbuchung._add_to_kundensaldo(cur, self.kunde, self.betrag)
+        self._stored_values = self._values()
+
         return self.id
 
     @property
@@ -1127,15 +2149,17 @@ def argparse_parse_currency(amount):
     try:
         amount = amount.replace(",", ".").replace("€", "")
         amount = amount.replace("EUR", "").strip()
-        return Decimal(amount)
-    except InvalidOperation as e:
-        raise argparse.ArgumentTypeError(e.message)
+        return check_betrag(Decimal(amount))
+    except InvalidOperation:
+        raise argparse.ArgumentTypeError(f"invalid amount: {amount}")
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
 
 
 def argparse_parse_client(value):
     """get a client out of the database by name or id"""
     cfg = scriptHelper.getConfig()
-    k = Kasse(cfg.get("general", "db_file"))
+    k = Kasse(cfg.get("general", "db_file"), cfg)
     try:
         return Kunde.load_from_id(int(value), k.cur)
     except (ValueError, NoDataFound):
@@ -1151,16 +2175,17 @@ def argparse_parse_client(value):
 def client_argcomplete(prefix, **kwargs):
     """tab completion for clients"""
     cfg = scriptHelper.getConfig()
-    k = Kasse(cfg.get("general", "db_file"))
-    lst = [c.name for c in k.kunden if c.name.startswith(prefix)]
-    lst += [str(c.id) for c in k.kunden if str(c.id).startswith(prefix)]
+    k = Kasse(cfg.get("general", "db_file"), cfg)
+    kunden = list(k.iter_kunden(load_buchungen=False))
+    lst = [c.name for c in kunden if c.name.startswith(prefix)]
+    lst += [str(c.id) for c in kunden if str(c.id).startswith(prefix)]
     return lst
 
 
 def argparse_parse_receipt(rid):
     """get the receipt from its id"""
     cfg = scriptHelper.getConfig()
-    k = Kasse(cfg.get("general", "db_file"))
+    k = Kasse(cfg.get("general", "db_file"), cfg)
     try:
         return Rechnung.load_from_id(int(rid), k.cur)
     except (ValueError, NoDataFound):
@@ -1172,7 +2197,7 @@ def argparse_parse_receipt(rid):
 def receipt_argcomplete(prefix, **kwargs):
     """tab completion for receipts"""
     cfg = scriptHelper.getConfig()
-    k = Kasse(cfg.get("general", "db_file"))
+    k = Kasse(cfg.get("general", "db_file"), cfg)
     return [str(r.id) for r in k.rechnungen if str(r.id).startswith(prefix)]
 
 
@@ -1276,6 +2301,36 @@ def parse_args(argv=sys.argv[1:]):
         dest="until_date",
         help=DATE_HELP,
     ).completer = date_argcomplete
+    # checkpoints
+    parser_checkpoints = subparsers.add_parser(
+        "checkpoints",
+        help="verify or rebuild the stored account and client balances",
+    )
+    parser_checkpoints.add_argument(
+        "what",
+        action="store",
+        choices=["verify", "rebuild"],
+        help="verify: compare with all bookings, rebuild: recalculate from all bookings",
+    )
+    # migrate
+    parser_migrate = subparsers.add_parser(
+        "migrate",
+        help="upgrade the database schema",
+    )
+    parser_migrate.add_argument(
+        "what",
+        action="store",
+        choices=["integer-cents"],
+        help="integer-cents: add integer columns for all amounts of money",
+    )
+    parser_migrate.add_argument(
+        "--batch-size",
+        action="store",
+        type=int,
+        default=1000,
+        dest="batch_size",
+        help="number of rows converted per transaction (default 1000)",
+    )
     # transfer
     parser_transfer = subparsers.add_parser(
         "transfer",
@@ -1478,7 +2533,7 @@ def main():
     os.chdir(os.path.dirname(os.path.realpath(__file__)))
 
     cfg = scriptHelper.getConfig()
-    k = Kasse(cfg.get("general", "db_file"))
+    k = Kasse(cfg.get("general", "db_file"), cfg)
 
     # r = Rechnung()
     # r.add_position("Plexiglas 5mm gruen", Decimal("0.015"), anzahl=100, einheit='qcm', produkt_ref='1000')
@@ -1522,7 +2577,7 @@ def main():
             # Header
             writer.writerow(["DATUM", "KONTO", "BETRAG", "RECH.NR.", "KOMMENTAR"])
             # Content
-            for b in k.buchungen:
+            for b in k.iter_buchungen(args.from_date, args.until_date):
                 writer.writerow(
                     [
                         str(b.datum),
@@ -1548,7 +2603,7 @@ def main():
                 ]
             )
             # Content
-            for r in k.rechnungen:
+            for r in k.iter_rechnungen(args.from_date, args.until_date):
                 for p in r.positionen:
                     writer.writerow(
                         [
@@ -1565,6 +2620,26 @@ def main():
                 writer.writerow([])
     elif args.action == "summary":
         print(k.summary_to_string(date=args.until_date, snapshot_time=startup_time))
+    elif args.action == "checkpoints":
+        if args.what == "rebuild":
+            k.rebuild_kontostand()
+            k.rebuild_kundensaldo()
+            print("[i] done")
+        errors = k.verify_kontostand() + k.verify_kundensaldo()
+        for error in errors:
+            print("[!] " + error, file=sys.stderr)
+        if errors:
+            sys.exit(1)
+        print("[i] checkpoints are consistent with all bookings")
+    elif args.action == "migrate":
+        if args.what == "integer-cents":
+            not_convertible = k.migrate_to_integer_cents(batch_size=args.batch_size)
+            if not_convertible:
+                print(
+                    "[i] {0} values are not representable as integers, "
+                    "they are only stored as text".format(not_convertible)
+                )
+            print("[i] done")
     elif args.action == "transfer":
 
         b1 = Buchung(args.source, -args.amount, kommentar=args.comment)
@@ -1805,47 +2880,26 @@ KdNr|                     Name|  Kontostand|  Grenze| Letzte Zahlung | Letzte Bu
 ----+-------------------------+------------+--------+----------------+----------------+"""
             )
 
-            for k in k.kunden:
-                last_payment = sorted(
-                    [b.datum for b in k.buchungen if b.betrag > 0], reverse=True
-                )[:1]
-                last_charge = sorted(
-                    [b.datum for b in k.buchungen if b.betrag < 0], reverse=True
-                )[:1]
-
-                # Using a skip flag, to allow overlapping filtering, where any filter will allow
-                # an entry to pass
-                skip = True
-                if args.inactive is not None and last_charge:
-                    # skip sufficiently active clients
-                    if (datetime.now() - last_charge[0]).days >= args.inactive:
-                        skip = False
-                if args.maxbalance is not None and k.summe < args.maxbalance:
-                    # skip clients with sufficient balance
-                    skip = False
-                if args.maxbalance is None and args.inactive is None:
-                    # Let everything pass if not filters were given
-                    skip = False
-                if args.remove_zeros and abs(k.summe) < 0.005:
-                    skip = True
-                if skip:
-                    continue
-
+            for kunde, last_payment, last_charge in k.list_kunden(
+                inactive_days=args.inactive,
+                max_balance=args.maxbalance,
+                remove_zeros=args.remove_zeros,
+            ):
                 if not last_payment:
                     last_payment = "n/a"
                 else:
-                    last_payment = last_payment[0].strftime("%Y-%m-%d")
+                    last_payment = last_payment.strftime("%Y-%m-%d")
                 if not last_charge:
                     last_charge = "n/a"
                 else:
-                    last_charge = last_charge[0].strftime("%Y-%m-%d")
+                    last_charge = last_charge.strftime("%Y-%m-%d")
 
                 print(
                     "{0:>4}|{1:>25}|{2:>8} EUR|{3:>8}| {4:>14} | {5:>14}".format(
-                        k.id,
-                        k.name,
-                        moneyfmt(k.summe),
-                        moneyfmt(k.schuldengrenze),
+                        kunde.id,
+                        kunde.name,
+                        moneyfmt(kunde.summe),
+                        moneyfmt(kunde.schuldengrenze),
                         last_payment,
                         last_charge,
                     )
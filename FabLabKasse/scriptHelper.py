@@ -73,9 +73,52 @@ def getConfig(path="./"):
     return cfg
 
 
+def configureDB(con, cfg):
+    """
+    apply the connection settings from the [database] section of the config to
+    a SQLite connection
+
+    The GUI, kassenbuch.py and other scripts access the same database file.
+    With the default settings (WAL), scripts reading the database do not block
+    the terminal from storing a sale.
+
+    :param con: SQLite connection
+    :type con: sqlite3.Connection
+    :param cfg: config from :func:`getConfig`
+    :raise: ValueError if a setting is invalid
+    """
+    journal_mode = cfg.get("database", "journal_mode", fallback="WAL").upper()
+    if journal_mode not in ["DELETE", "TRUNCATE", "PERSIST", "MEMORY", "WAL", "OFF"]:
+        raise ValueError("invalid database journal_mode: " + journal_mode)
+    synchronous = cfg.get("database", "synchronous", fallback="FULL").upper()
+    if synchronous not in ["OFF", "NORMAL", "FULL", "EXTRA"]:
+        raise ValueError("invalid database synchronous setting: " + synchronous)
+    busy_timeout = cfg.getint("database", "busy_timeout", fallback=10000)
+    cache_size = cfg.getint("database", "cache_size", fallback=-16000)
+    mmap_size = cfg.getint("database", "mmap_size", fallback=0)
+
+    cur = con.cursor()
+    # busy_timeout first, changing the journal mode may need to wait for a lock
+    cur.execute("PRAGMA busy_timeout = {0:d}".format(busy_timeout))
+    result = cur.execute("PRAGMA journal_mode = {0}".format(journal_mode)).fetchone()
+    if result[0].upper() != journal_mode:
+        # e.g. in-memory databases always use journal_mode MEMORY
+        logging.debug(
+            "database journal_mode {0} not available, using {1}".format(
+                journal_mode, result[0]
+            )
+        )
+    cur.execute("PRAGMA synchronous = {0}".format(synchronous))
+    cur.execute("PRAGMA cache_size = {0:d}".format(cache_size))
+    cur.execute("PRAGMA mmap_size = {0:d}".format(mmap_size))
+    cur.close()
+
+
 def getDB():
     cfg = getConfig()
-    return sqlite3.connect(cfg.get("general", "db_file"))
+    con = sqlite3.connect(cfg.get("general", "db_file"))
+    configureDB(con, cfg)
+    return con
 
 
 class FileLock(object):
@@ -125,6 +125,8 @@ def format_money(amount):
 class Category(object):
     """represents a category of Products"""
 
+    __slots__ = ["categ_id", "name", "parent_id"]
+
     def __init__(self, categ_id, name, parent_id=None):
         self.categ_id = categ_id
         self.name = name
@@ -165,6 +167,17 @@ class Product(object):
     :type qty_rounding: int | Decimal
     """
 
+    __slots__ = [
+        "prod_id",
+        "name",
+        "price",
+        "location",
+        "categ_id",
+        "unit",
+        "text_entry_required",
+        "qty_rounding",
+    ]
+
     def __init__(
         self,
         prod_id,
@@ -213,6 +226,16 @@ class OrderLine(object):
        [ usually True, set to False for products that also may as comment limes costing nothing ]
     """
 
+    __slots__ = [
+        "order_line_id",
+        "qty",
+        "unit",
+        "name",
+        "price_per_unit",
+        "price_subtotal",
+        "delete_if_zero_qty",
+    ]
+
     def __init__(
         self,
         order_line_id,
@@ -280,6 +303,26 @@ class PrinterError(Exception):
     pass
 
 
+class SearchSession(object):
+
+    """search-as-you-type: a sequence of searches while the user is typing
+
+    This default implementation searches every query from scratch with
+    :meth:`AbstractShoppingBackend.search_from_text`. Backends may return a
+    subclass that reuses the previous results.
+    """
+
+    def __init__(self, backend):
+        """:param backend: shopping backend
+        :type backend: AbstractShoppingBackend
+        """
+        self._backend = backend
+
+    def search(self, searchstr):
+        """search searchstr, see :meth:`AbstractShoppingBackend.search_from_text`"""
+        return self._backend.search_from_text(searchstr)
+
+
 class AbstractShoppingBackend(object):
 
     """manages products, categories and orders (cart)"""
@@ -372,6 +415,39 @@ class AbstractShoppingBackend(object):
         """
         pass
 
+    def start_search_session(self):
+        """start a new search-as-you-type session
+
+        use this instead of :meth:`search_from_text` for repeated searches while
+        the user is typing. The session must be discarded if the products or
+        categories change.
+
+        :rtype: SearchSession
+        """
+        return SearchSession(self)
+
+    def load_catalog(self):
+        """load products and categories again, e.g. to get new prices
+
+        This is called in a background thread and must not modify the backend.
+        The result is applied later with :meth:`set_catalog`.
+
+        :return: backend-specific catalog object, or None if reloading is not supported
+        """
+        return None
+
+    def set_catalog(self, catalog):
+        """replace products and categories by the result of :meth:`load_catalog`
+
+        Existing order lines keep their products and prices. Search sessions
+        started before must not be used anymore.
+        """
+        raise NotImplementedError()
+
+    def category_exists(self, categ_id):
+        """is categ_id a valid category id, e.g. after :meth:`set_catalog`?"""
+        raise NotImplementedError()
+
     #
     # order handling
     #
@@ -31,52 +31,245 @@ from ... import scriptHelper
 from ...kassenbuch import Kasse, Rechnung, Buchung, Kunde
 import socket
 import itertools
+import collections
 import sqlite3
 import urllib.request
 import urllib.parse  # for url encoding for "caching" the json
 import json
+import codecs
+import re
+import hashlib
 import logging
 import contextlib  # for "caching" the json
 import os
+import io
+import shutil
+import tempfile
+import time
+import urllib.error
 from typing import Tuple
 
 
-def load_json_from_url(url):
+def load_json_from_url(url, max_age=0):
     """
     Fetch JSON from URL and decode it
+
+    :param max_age: see :func:`download_with_fallback`
     """
-    with download_with_fallback(url) as f:
+    with download_with_fallback(url, max_age, _validate_json) as f:
         return json.load(f)
 
 
+def _validate_json(filename):
+    """raise ValueError if the file does not contain valid JSON"""
+    with open(filename) as f:
+        json.load(f)
+
+
+def _validate_json_object(filename):
+    """raise ValueError if the file does not contain a valid JSON object, without loading it completely"""
+    with open(filename, "rb") as f:
+        for _ in iter_json_object_items(f):
+            pass
+
+
+_JSON_WHITESPACE = re.compile(r"[ \t\n\r]*")
+
+
+def iter_json_object_items(f, chunk_size=64 * 1024):
+    """
+    Parse a JSON object incrementally and yield its items (key, value) one by one.
+
+    Only the current item is kept in memory, not the whole object.
+
+    :param f: binary file (UTF-8)
+    :param chunk_size: number of bytes read at once
+    :raise: ValueError if the file does not contain a JSON object
+    """
+    decoder = json.JSONDecoder()
+    chunks = codecs.iterdecode(iter(lambda: f.read(chunk_size), b""), "utf8")
+    buf = ""
+    pos = 0
+    eof = False
+
+    def read_more():
+        nonlocal buf, pos, eof
+        chunk = next(chunks, None)
+        if chunk is None:
+            eof = True
+        else:
+            buf = buf[pos:] + chunk
+            pos = 0
+
+    def skip_whitespace():
+        nonlocal pos
+        while True:
+            pos = _JSON_WHITESPACE.match(buf, pos).end()
+            if pos < len(buf) or eof:
+                return
+            read_more()
+
+    def expect(chars):
+        """consume one of the given chars and return it"""
+        nonlocal pos
+        skip_whitespace()
+        if pos >= len(buf) or buf[pos] not in chars:
+            raise ValueError(
+                f"invalid JSON object: expected one of {chars!r} at {buf[pos:pos + 20]!r}"
+            )
+        pos += 1
+        return buf[pos - 1]
+
+    def decode_value():
+        nonlocal pos
+        skip_whitespace()
+        while True:
+            try:
+                (value, end) = decoder.raw_decode(buf, pos)
+            except ValueError:
+                if eof:
+                    raise
+                read_more()
+                continue
+            if end == len(buf) and not eof:
+                # a number may continue in the next chunk
+                read_more()
+                continue
+            pos = end
+            return value
+
+    expect("{")
+    skip_whitespace()
+    if pos < len(buf) and buf[pos] == "}":
+        pos += 1
+    else:
+        while True:
+            key = decode_value()
+            if not isinstance(key, str):
+                raise ValueError("invalid JSON object: key is not a string")
+            expect(":")
+            yield (key, decode_value())
+            if expect(",}") == "}":
+                break
+    skip_whitespace()
+    if pos < len(buf):
+        raise ValueError("invalid JSON object: extra data after the end")
+
+
+def _read_cache_metadata(filename):
+    """return the HTTP cache validators stored for a downloaded file"""
+    try:
+        with open(filename + ".meta") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _replace_file(filename, data, validate=None):
+    """atomically replace the file with the given content
+
+    The content is written to a temporary file first, so that readers never
+    see a partial file and a failed download keeps the old version.
+
+    :param data: file-like object with the new content (bytes)
+    :param validate: function that checks the temporary file, or None
+    """
+    (fd, tmp_filename) = tempfile.mkstemp(
+        dir=os.path.dirname(filename), prefix=os.path.basename(filename) + "."
+    )
+    try:
+        with os.fdopen(fd, "wb") as f:
+            shutil.copyfileobj(data, f)
+        if validate is not None:
+            validate(tmp_filename)
+        os.replace(tmp_filename, filename)
+    except BaseException:
+        os.unlink(tmp_filename)
+        raise
+
+
+def _update_cached_download(url, filename, max_age=0, validate=None):
+    """
+    Update the local copy of the resource at the given URL.
+
+    see :func:`download_with_fallback`
+    """
+    if os.path.isfile(filename):
+        age = time.time() - os.path.getmtime(filename)
+        if age < max_age:
+            logging.debug(f"Using cached {filename} ({age:.0f}s old) for {url}")
+            return
+        metadata = _read_cache_metadata(filename)
+    else:
+        metadata = {}
+    request = urllib.request.Request(url)
+    if metadata.get("etag"):
+        request.add_header("If-None-Match", metadata["etag"])
+    if metadata.get("last_modified"):
+        request.add_header("If-Modified-Since", metadata["last_modified"])
+    logging.debug(f"Downloading from {url} to {filename}…")
+    try:
+        response = urllib.request.urlopen(request)
+    except urllib.error.HTTPError as exc:
+        if exc.code == 304 and os.path.isfile(filename):
+            logging.debug(f"{filename} is still up to date")
+            # restart max_age
+            os.utime(filename)
+            return
+        raise
+
+    def validate_and_remove_metadata(tmp_filename):
+        if validate is not None:
+            validate(tmp_filename)
+        # the validators of the old version must not be used for the new one
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(filename + ".meta")
+
+    with response:
+        _replace_file(filename, response, validate_and_remove_metadata)
+        metadata = {
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+        }
+    _replace_file(filename + ".meta", io.BytesIO(json.dumps(metadata).encode("utf8")))
+
+
 @contextlib.contextmanager
-def download_with_fallback(url):
+def download_with_fallback(url, max_age=0, validate=None):
     """
     Downloads the resource at the given URL and saves it locally.
+
+    If the local copy is younger than max_age seconds, it is used without
+    asking the server. Otherwise, it is revalidated with ETag / Last-Modified,
+    so that unchanged data is not downloaded again.
+    The local copy is replaced atomically, and only if
+    ``validate(temporary_filename)`` does not raise an exception.
+
     In case the download fails, a previous locally downloaded version is used.
-    If no prior download was successful,
+    If no prior download was successful, the download is retried without caching.
+
+    :param max_age: maximum age of the local copy in seconds
+    :param validate: function that checks a downloaded file, or None
     """
     filename = f"out/{urllib.parse.quote(url, '')}"
     os.makedirs("out", exist_ok=True)
     try:
-        logging.debug(f"Downloading from {url} to {filename}…")
-        urllib.request.urlretrieve(url, filename)
-        with open(filename) as f:
-            yield f
+        _update_cached_download(url, filename, max_age, validate)
     except Exception as exc:
         if os.path.isfile(filename):
             logging.error(
                 f"Failed to download from {url}, using local cached version at {filename} instead. This version may be outdated.",
                 exc_info=exc,
             )
-            with open(filename) as f:
-                yield f
         else:
             logging.error(
                 f"Failed to download from {url}. In addition, no cached version exists. Falling back to direct download…"
             )
             with urllib.request.urlopen(url) as f:
                 yield f
+            return
+    with open(filename, "rb") as f:
+        yield f
 
 
 def load_categories_from_web(cfg) -> Tuple[list[Category], int]:
@@ -98,7 +291,9 @@ def load_categories_from_web(cfg) -> Tuple[list[Category], int]:
     """
     categories = []
     CATEGORIES_JSON_URL = cfg.get("backend", "categories_json")
-    categories_raw = load_json_from_url(CATEGORIES_JSON_URL)
+    categories_raw = load_json_from_url(
+        CATEGORIES_JSON_URL, cfg.getint("backend", "catalog_max_age", fallback=0)
+    )
     # [{'id': 1, 'property_stock_location': False, 'name': 'Alle Produkte', 'parent_id': False}, ..., {'id': 118, 'property_stock_location': False, 'name': 'Lasermaterial', 'parent_id': [117, 'Alle Produkte / Laser']}]
     root_category_id = None
     for c in categories_raw:
@@ -154,10 +349,47 @@ def load_products_from_web(cfg):
     }
     """
     PRODUCTS_JSON_URL = cfg.get("backend", "products_json")
+    with download_with_fallback(
+        PRODUCTS_JSON_URL,
+        cfg.getint("backend", "catalog_max_age", fallback=0),
+        _validate_json_object,
+    ) as f:
+        return load_products_from_json(
+            f, f"out/{urllib.parse.quote(PRODUCTS_JSON_URL, '')}.products.sqlite3"
+        )
+
+
+# increase if the format of the compiled product list changes
+COMPILED_PRODUCTS_VERSION = 1
+
+
+def load_products_from_json(f, compiled_filename=None):
+    """
+    Parse the list of products (see :func:`load_products_from_web`)
+
+    The JSON is parsed incrementally, so that the unused fields of a product
+    are discarded before the next one is read.
+    Additionally, the parsed products are stored in a small SQLite database
+    (compiled_filename) and loaded from there as long as the JSON does not change.
+
+    :param f: binary file with the JSON
+    :param compiled_filename: path of the compiled product list, or None to always parse the JSON.
+                              Only used if ``f`` is seekable.
+    :rtype: list[Product]
+    """
+    source_hash = None
+    if compiled_filename is not None and f.seekable():
+        sha256 = hashlib.sha256()
+        for chunk in iter(lambda: f.read(64 * 1024), b""):
+            sha256.update(chunk)
+        f.seek(0)
+        source_hash = sha256.hexdigest()
+        products = _read_compiled_products(compiled_filename, source_hash)
+        if products is not None:
+            return products
 
     products = []
-    products_raw = load_json_from_url(PRODUCTS_JSON_URL)
-    for p in products_raw.values():
+    for (_, p) in iter_json_object_items(f):
         price = Decimal(str(p["lst_price"]))
         if price <= 0:
             # skip products with price 0 until we have a better UI (price labels show "please donate" if the price is 0, the GUI here doesn't support that)
@@ -174,35 +406,161 @@ def load_products_from_web(cfg):
                 qty_rounding=Decimal(str(p["_uom_rounding"])),
             )
         )
+
+    if source_hash is not None:
+        try:
+            _write_compiled_products(compiled_filename, source_hash, products)
+        except (OSError, sqlite3.Error) as exc:
+            logging.warning(
+                f"Failed to store compiled product list {compiled_filename}",
+                exc_info=exc,
+            )
     return products
 
 
+def _read_compiled_products(filename, source_hash):
+    """
+    load the products stored by :func:`_write_compiled_products`
+
+    :return: list of products, or None if the file is missing, outdated or broken
+    """
+    if not os.path.isfile(filename):
+        return None
+    try:
+        with contextlib.closing(sqlite3.connect(filename)) as con:
+            cur = con.cursor()
+            cur.execute("PRAGMA user_version")
+            if cur.fetchone()[0] != COMPILED_PRODUCTS_VERSION:
+                return None
+            cur.execute("SELECT sha256 FROM source")
+            if cur.fetchone() != (source_hash,):
+                return None
+            cur.execute(
+                "SELECT prod_id, name, price, unit, location, categ_id, "
+                "text_entry_required, qty_rounding FROM product ORDER BY rowid"
+            )
+            return [
+                Product(
+                    prod_id=prod_id,
+                    name=name,
+                    price=Decimal(price),
+                    unit=unit,
+                    location=location,
+                    categ_id=categ_id,
+                    text_entry_required=bool(text_entry_required),
+                    qty_rounding=Decimal(qty_rounding),
+                )
+                for (
+                    prod_id,
+                    name,
+                    price,
+                    unit,
+                    location,
+                    categ_id,
+                    text_entry_required,
+                    qty_rounding,
+                ) in cur.fetchall()
+            ]
+    except sqlite3.Error as exc:
+        logging.warning(
+            f"Ignoring broken compiled product list {filename}", exc_info=exc
+        )
+        return None
+
+
+def _write_compiled_products(filename, source_hash, products):
+    """atomically store the products for :func:`_read_compiled_products`"""
+    (fd, tmp_filename) = tempfile.mkstemp(
+        dir=os.path.dirname(filename) or ".", prefix=os.path.basename(filename) + "."
+    )
+    os.close(fd)
+    try:
+        with contextlib.closing(sqlite3.connect(tmp_filename)) as con:
+            con.execute("PRAGMA user_version = {0:d}".format(COMPILED_PRODUCTS_VERSION))
+            con.execute("CREATE TABLE source (sha256 TEXT NOT NULL)")
+            con.execute("INSERT INTO source VALUES (?)", (source_hash,))
+            con.execute(
+                "CREATE TABLE product (prod_id INTEGER, name TEXT, price TEXT, "
+                "unit TEXT, location TEXT, categ_id INTEGER, "
+                "text_entry_required INTEGER, qty_rounding TEXT)"
+            )
+            con.executemany(
+                "INSERT INTO product VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    (
+                        p.prod_id,
+                        p.name,
+                        str(p.price),
+                        p.unit,
+                        p.location,
+                        p.categ_id,
+                        int(p.text_entry_required),
+                        str(p.qty_rounding),
+                    )
+                    for p in products
+                ),
+            )
+            con.commit()
+        os.replace(tmp_filename, filename)
+    except BaseException:
+        os.unlink(tmp_filename)
+        raise
+
+
 def remove_empty_categories(
     products: list[Product], categories: list[Category]
 ) -> list[Category]:
     """
     take a list of Products and Categories. Recursively remove all categories that contain no products.
+
+    A category is kept if it is a root category (parent_id is None), contains
+    a product or contains a category that is kept. The order of the
+    categories is not changed.
+    """
+    products_categ_ids = set(p.categ_id for p in products)
+    parent_ids = {c.categ_id: c.parent_id for c in categories}
+    # number of subcategories that have not been removed
+    num_children = collections.Counter(c.parent_id for c in categories)
+
+    def is_empty(categ_id):
+        return (
+            parent_ids[categ_id] is not None
+            and categ_id not in products_categ_ids
+            and num_children[categ_id] == 0
+        )
+
+    # remove empty leaves, then check whether their parent became an empty leaf
+    removed = set()
+    to_remove = [c.categ_id for c in categories if is_empty(c.categ_id)]
+    while to_remove:
+        categ_id = to_remove.pop()
+        if categ_id in removed:
+            continue
+        removed.add(categ_id)
+        parent_id = parent_ids[categ_id]
+        num_children[parent_id] -= 1
+        if parent_id in parent_ids and is_empty(parent_id):
+            to_remove.append(parent_id)
+    return [c for c in categories if c.categ_id not in removed]
+
+
+def load_catalog_from_web(cfg):
     """
-    # iterate until nothing changes (simplified: just iterate enough times)
-    for i in range(99):
-        # keep a category if...
-        # it is the root category
-        keep_categories = [c.categ_id for c in categories if c.parent_id is None]
-        # or it contains another category
-        keep_categories += [c.parent_id for c in categories]
-        # or it contains a product
-        keep_categories += [p.categ_id for p in products]
-        categories = list([c for c in categories if c.categ_id in keep_categories])
-    return categories
+    Download and parse products and categories, without empty categories
+
+    :return: (categories, products, root_category_id)
+    """
+    products = load_products_from_web(cfg)
+    (categories, root_category_id) = load_categories_from_web(cfg)
+    categories = remove_empty_categories(products, categories)
+    return (categories, products, root_category_id)
 
 
 class ShoppingBackend(AbstractOfflineShoppingBackend):
     def __init__(self, cfg):
-        self._kasse = Kasse(cfg.get("general", "db_file"))
+        self._kasse = Kasse(cfg.get("general", "db_file"), cfg)
 
-        products = load_products_from_web(cfg)
-        (categories, root_category_id) = load_categories_from_web(cfg)
-        categories = remove_empty_categories(products, categories)
+        (categories, products, root_category_id) = load_catalog_from_web(cfg)
 
         assert (
             cfg.getint("payup_methods", "overpayment_product_id") == 9999
@@ -220,9 +578,12 @@ class ShoppingBackend(AbstractOfflineShoppingBackend):
             root_category_id=root_category_id,
         )
 
+    def _load_categories_and_products(self):
+        return load_catalog_from_web(self.cfg)
+
     def list_clients(self):
         clients = {}
-        for k in self._kasse.kunden:
+        for k in self._kasse.iter_kunden(load_buchungen=False):
             debt_limit = k.schuldengrenze
             if debt_limit < 0:
                 debt_limit = Decimal("Infinity")
@@ -265,12 +626,15 @@ class ShoppingBackend(AbstractOfflineShoppingBackend):
             raise Exception("unsupported payment method")
         rechnung = self._rechnung_from_order_lines()
         assert rechnung.summe == method.amount_paid - method.amount_returned
-        rechnung.store(self._kasse.cur)
-        logging.info("stored payment in Rechnung#{0}".format(rechnung.id))
+        with self._kasse.transaction():
+            rechnung.store(self._kasse.cur)
 
-        b1 = Buchung(str(destination), rechnung.summe, rechnung=rechnung.id)
-        b2 = Buchung(str(origin), -rechnung.summe, rechnung=rechnung.id, datum=b1.datum)
-        self._kasse.buchen([b1, b2])  # implies database commit
+            b1 = Buchung(str(destination), rechnung.summe, rechnung=rechnung.id)
+            b2 = Buchung(
+                str(origin), -rechnung.summe, rechnung=rechnung.id, datum=b1.datum
+            )
+            self._kasse.buchen([b1, b2])
+        logging.info("stored payment in Rechnung#{0}".format(rechnung.id))
 
         self._get_current_order_obj().rechnung_for_receipt = rechnung
 
@@ -321,11 +685,12 @@ class ShoppingBackend(AbstractOfflineShoppingBackend):
         raise NotImplementedError()
 
     def _store_client_payment(self, client):
-        kunde = Kunde.load_from_id(client.client_id, self._kasse.cur)
+        kunde = Kunde.load_from_id(
+            client.client_id, self._kasse.cur, load_buchungen=False
+        )
         rechnung = self._rechnung_from_order_lines()
-        rechnung.store(self._kasse.cur)
+        with self._kasse.transaction():
+            rechnung.store(self._kasse.cur)
+            kunde.add_buchung(-rechnung.summe, rechnung=rechnung.id)
+            kunde.store(self._kasse.cur)
         logging.info("stored client payment in Rechnung#{0}".format(rechnung.id))
-
-        kunde.add_buchung(-rechnung.summe, rechnung=rechnung.id)
-        kunde.store(self._kasse.cur)
-        self._kasse.con.commit()
@@ -14,17 +14,24 @@ from .abstract import (
     OrderLine,
     ProductNotFound,
     PrinterError,
+    SearchSession,
 )
 from decimal import Decimal
 from ... import scriptHelper
-from natsort import natsorted
+from natsort import natsort_keygen
 import re
+import array
+import collections
+import functools
+import itertools
 
 
 class ProductBasedOrderLine(OrderLine):
 
     """OrderLine that references a Product"""
 
+    __slots__ = ["product", "_qty"]
+
     def __init__(self, product, qty, comment=None):
         """create order line automatically just from Product instance and quantity
         The product can later be accessed by this.product
@@ -75,6 +82,155 @@ class ProductBasedOrderLine(OrderLine):
         self.qty = qty.normalize()  # use normalize() to strip trailing ,0000
 
 
+def simplify_searchstring(string):
+    """normalize a name or search string for case-insensitive substring search"""
+    # remove silly BOM
+    string = string.replace("\ufeff", "")
+    # all whitespace is treated equal
+    string = re.sub(r"(\s+)", " ", string)
+    string = string.replace("\u2010", "-")  # unicode dash
+    return string.lower().strip()
+
+
+_natsort_key = natsort_keygen()
+
+
+def name_sort_key(name):
+    """key for sorting products or categories naturally by their simplified name
+
+    This is expensive, so the keys are computed once when the product or
+    category is added to an :class:`OfflineCategoryTree`.
+    """
+    return _natsort_key(simplify_searchstring(name))
+
+
+class SearchIndex(object):
+
+    """inverted trigram index for searching names by substrings
+
+    A name matches a search string if every (space separated) keyword of the
+    search string is contained in the name, ignoring case and whitespace
+    differences (see :func:`simplify_searchstring`).
+
+    Entries are numbered by their rank in natural sort order. For every
+    substring of :attr:`GRAM_LENGTH` characters, the index stores the sorted
+    ranks of all names containing it as a compact array. A keyword of three
+    or more characters can only be contained in names listed in the arrays of
+    all its trigrams. Shorter keywords are answered by scanning the simplified
+    names once; the result is kept for later searches. Only the names in the
+    smallest of these arrays are then checked for all keywords.
+
+    Sort order and index are built on the first search after adding entries,
+    so that loading a catalog stays fast.
+    """
+
+    GRAM_LENGTH = 3
+
+    def __init__(self):
+        self._names = {}  # key -> simplified name
+        self._sort_keys = {}  # key -> natural sort key of the name
+        # built on demand by _update_index():
+        self._sorted_keys = None  # keys in natural sort order (rank -> key)
+        self._sorted_names = None  # rank -> simplified name
+        self._index = None  # trigram -> array of ranks
+        self._short_index = None  # keyword shorter than a trigram -> array of ranks
+
+    def add(self, key, name, sort_key=None):
+        """add an entry
+
+        :param key: unique key, returned by :meth:`search`
+        :param name: name to be searched
+        :type name: str
+        :param sort_key: ``name_sort_key(name)`` if already known
+        """
+        assert key not in self._names, "key {0} already exists".format(key)
+        if sort_key is None:
+            sort_key = name_sort_key(name)
+        self._names[key] = simplify_searchstring(name)
+        self._sort_keys[key] = sort_key
+        self._sorted_keys = None
+
+    def _update_index(self):
+        if self._sorted_keys is not None:
+            return
+        sorted_keys = sorted(self._names, key=self._sort_keys.__getitem__)
+        sorted_names = [self._names[key] for key in sorted_keys]
+        # keywords never contain spaces, so trigrams across words are not needed.
+        # Ranks are appended in increasing order, so every array is sorted.
+        index = collections.defaultdict(functools.partial(array.array, "I"))
+        n = self.GRAM_LENGTH
+        for rank, name in enumerate(sorted_names):
+            words = name.split(" ")
+            for gram in {w[i : i + n] for w in words for i in range(len(w) - n + 1)}:
+                index[gram].append(rank)
+        self._sorted_names = sorted_names
+        self._index = dict(index)
+        self._short_index = {}
+        self._sorted_keys = sorted_keys
+
+    def _postings(self, keyword):
+        """arrays of ranks for ``keyword``
+
+        Every name containing ``keyword`` is contained in all of these arrays.
+        If ``keyword`` is not longer than GRAM_LENGTH, the converse is also
+        true.
+        """
+        n = self.GRAM_LENGTH
+        if len(keyword) < n:
+            if keyword not in self._short_index:
+                self._short_index[keyword] = array.array(
+                    "I",
+                    [
+                        rank
+                        for rank, name in enumerate(self._sorted_names)
+                        if keyword in name
+                    ],
+                )
+            return [self._short_index[keyword]]
+        empty = array.array("I")
+        return [
+            self._index.get(keyword[i : i + n], empty)
+            for i in range(len(keyword) - n + 1)
+        ]
+
+    def search(self, searchstr, within=None):
+        """return the keys of all entries matching ``searchstr``
+
+        :param within: if given, only search these keys. They must be in the
+                       order returned by :meth:`search`, for example the
+                       result for a shorter search string.
+        :type within: list | None
+        :return: keys, naturally sorted by their (simplified) name
+        :rtype: list
+        """
+        keywords = [k for k in simplify_searchstring(searchstr).split(" ") if k]
+        if within is not None:
+            names = self._names
+            return [
+                key
+                for key in within
+                if all(keyword in names[key] for keyword in keywords)
+            ]
+        self._update_index()
+        if not keywords:
+            return list(self._sorted_keys)
+        postings = []
+        for keyword in keywords:
+            postings += self._postings(keyword)
+        names = self._sorted_names
+        if len(keywords) == 1 and len(keywords[0]) <= self.GRAM_LENGTH:
+            # the array of a single short keyword is the exact result
+            ranks = postings[0]
+        else:
+            # every match is contained in the smallest array, so only its
+            # entries are checked. This is cheaper than intersecting the
+            # (often much larger) other arrays.
+            ranks = min(postings, key=len)
+            for keyword in keywords:
+                ranks = [rank for rank in ranks if keyword in names[rank]]
+        return [self._sorted_keys[rank] for rank in ranks]
+
+
 class OfflineCategoryTree(object):
 
     """local storage for a tree of categories and products"""
@@ -93,6 +249,18 @@ class OfflineCategoryTree(object):
         self.root_category_id = root_category_id
         self.categories = {}
         self.products = {}
+        self._category_search_index = SearchIndex()
+        self._product_search_index = SearchIndex()
+        # parent category id -> list of subcategories
+        self._subcategories = {}
+        # category id -> list of products
+        self._products_in_category = {}
+        # category id -> naturally sorted lists of the above, built on demand
+        self._sorted_subcategories = {}
+        self._sorted_products = {}
+        # id -> name_sort_key(name)
+        self._category_sort_keys = {}
+        self._product_sort_keys = {}
         if generate_root_category:
             categories += [
                 Category(categ_id=root_category_id, name="root", parent_id=None)
@@ -120,73 +288,68 @@ class OfflineCategoryTree(object):
             categ_id, repr(category.name), repr(self.categories[categ_id].name)
         )
         self.categories[categ_id] = category
+        sort_key = name_sort_key(category.name)
+        self._category_sort_keys[categ_id] = sort_key
+        self._subcategories.setdefault(category.parent_id, []).append(category)
+        self._sorted_subcategories.pop(category.parent_id, None)
+        if categ_id != self.root_category_id:
+            self._category_search_index.add(categ_id, category.name, sort_key)
 
     def add_product(self, product):
         prod_id = product.prod_id
         assert prod_id not in self.products, "Product already exists"
         self.products[prod_id] = product
+        sort_key = name_sort_key(product.name)
+        self._product_sort_keys[prod_id] = sort_key
+        self._products_in_category.setdefault(product.categ_id, []).append(product)
+        self._sorted_products.pop(product.categ_id, None)
+        self._product_search_index.add(prod_id, product.name, sort_key)
 
     def get_root_category(self):
         return self.categories[self.root_category_id]
 
     def get_subcategories(self, categ_id):
-        return self._sort_categories(
-            filter(lambda categ: categ.parent_id == categ_id, self.categories.values())
-        )
+        if categ_id not in self._sorted_subcategories:
+            self._sorted_subcategories[categ_id] = self._sort_categories(
+                self._subcategories.get(categ_id, [])
+            )
+        return list(self._sorted_subcategories[categ_id])
 
-    @staticmethod
-    def simplify_searchstring(string):
-        # remove silly BOM
-        string = string.replace("\ufeff", "")
-        # all whitespace is treated equal
-        string = re.sub(r"(\s+)", " ", string)
-        string = string.replace("\u2010", "-")  # unicode dash
-        return string.lower().strip()
+    simplify_searchstring = staticmethod(simplify_searchstring)
 
     def _sort_products(self, product_list):
-        return natsorted(
-            product_list,
-            key=lambda prod: OfflineCategoryTree.simplify_searchstring(prod.name),
-        )
+        sort_keys = self._product_sort_keys
+        return sorted(product_list, key=lambda prod: sort_keys[prod.prod_id])
 
     def _sort_categories(self, categ_list):
-        return natsorted(
-            categ_list,
-            key=lambda cat: OfflineCategoryTree.simplify_searchstring(cat.name),
-        )
+        sort_keys = self._category_sort_keys
+        return sorted(categ_list, key=lambda cat: sort_keys[cat.categ_id])
 
     def get_products(self, categ_id):
-        return self._sort_products(
-            filter(lambda prod: prod.categ_id == categ_id, self.products.values())
-        )
+        if categ_id not in self._sorted_products:
+            self._sorted_products[categ_id] = self._sort_products(
+                self._products_in_category.get(categ_id, [])
+            )
+        return list(self._sorted_products[categ_id])
 
-    def search_products(self, searchstr):
-        searchlist = OfflineCategoryTree.simplify_searchstring(searchstr).split(" ")
+    def search_product_ids(self, searchstr, within=None):
+        """ids of matching products, see :meth:`SearchIndex.search`"""
+        return self._product_search_index.search(searchstr, within)
 
-        def matches(product):
-            for keyword in searchlist:
-                if keyword == "":
-                    continue
-                if not keyword in OfflineCategoryTree.simplify_searchstring(
-                    product.name
-                ):
-                    return False
-            return True
+    def search_category_ids(self, searchstr, within=None):
+        """ids of matching categories, see :meth:`SearchIndex.search`"""
+        return self._category_search_index.search(searchstr, within)
 
-        return self._sort_products(filter(matches, self.products.values()))
+    def search_products(self, searchstr):
+        return [
+            self.products[prod_id] for prod_id in self.search_product_ids(searchstr)
+        ]
 
     def search_categories(self, searchstr):
-        searchlist = OfflineCategoryTree.simplify_searchstring(searchstr).split(" ")
-
-        def matches(categ):
-            if categ == self.get_root_category():
-                return False
-            for keyword in searchlist:
-                if not keyword in OfflineCategoryTree.simplify_searchstring(categ.name):
-                    return False
-            return True
-
-        return self._sort_categories(filter(matches, self.categories.values()))
+        return [
+            self.categories[categ_id]
+            for categ_id in self.search_category_ids(searchstr)
+        ]
 
     def get_product(self, prod_id):
         try:
@@ -210,43 +373,108 @@ class OfflineCategoryTree(object):
         return path
 
 
+class OfflineSearchSession(SearchSession):
+
+    """search-as-you-type session that refines the previous results
+
+    The results of the previous search strings are kept on a stack. If the
+    new search string extends a previous one, only the previous results are
+    searched. Deleting characters returns the stored result again.
+    """
+
+    def __init__(self, backend):
+        super(OfflineSearchSession, self).__init__(backend)
+        # list of tuples (simplified search string, category ids, product ids)
+        self._stack = []
+
+    def _search_ids(self, searchstr):
+        searchstr = simplify_searchstring(searchstr)
+        tree = self._backend.tree
+        # drop results that are not a prefix of the new search string
+        while self._stack and not searchstr.startswith(self._stack[-1][0]):
+            self._stack.pop()
+        if self._stack and self._stack[-1][0] == searchstr:
+            return self._stack[-1][1:]
+        if self._stack:
+            # every keyword of the shorter search string is contained in a
+            # keyword of the new one, so the result can only get smaller
+            (_, categ_ids, prod_ids) = self._stack[-1]
+            categ_ids = tree.search_category_ids(searchstr, within=categ_ids)
+            prod_ids = tree.search_product_ids(searchstr, within=prod_ids)
+        else:
+            categ_ids = tree.search_category_ids(searchstr)
+            prod_ids = tree.search_product_ids(searchstr)
+        self._stack.append((searchstr, categ_ids, prod_ids))
+        return (categ_ids, prod_ids)
+
+    def search(self, searchstr):
+        (categ_ids, prod_ids) = self._search_ids(searchstr)
+        tree = self._backend.tree
+        return (
+            [tree.categories[categ_id] for categ_id in categ_ids],
+            self._backend._search_products_from_code(searchstr)
+            + [tree.products[prod_id] for prod_id in prod_ids],
+        )
+
+
+# counter for unique order ids, starting at 1 so that every id is true-ish
+_order_id_counter = itertools.count(1)
+
+
 class Order(object):
 
     """simple shopping cart for use in ShoppingBackend"""
 
     def __init__(self):
-        self._lines = []
+        self.order_id = next(_order_id_counter)
+        # order_line_id -> ProductBasedOrderLine, in the order they were added
+        self._lines = {}
+        # sum of price_subtotal of all lines, updated on every change
+        self._total = Decimal(0)
         self._finished = False
 
-    def _idx_from_id(self, order_line_id):
-        for i, line in enumerate(self._lines):
-            if line.order_line_id == order_line_id:
-                return i
-        raise KeyError("invalid order_line_id")
+    @property
+    def total(self):
+        """sum of the (unrounded) subtotals of all lines"""
+        return self._total
+
+    def _get_line(self, order_line_id):
+        try:
+            return self._lines[order_line_id]
+        except KeyError:
+            raise KeyError("invalid order_line_id")
 
     def update_quantity(self, order_line_id, qty):
         assert not self._finished, "finished orders may not be modified"
         assert isinstance(qty, (Decimal, int))
-        order_line = self._lines[self._idx_from_id(order_line_id)]
+        order_line = self._get_line(order_line_id)
+        old_subtotal = order_line.price_subtotal
         order_line.set_quantity_rounded(qty)
+        self._total += order_line.price_subtotal - old_subtotal
 
     def get_order_lines(self):
-        return self._lines
+        return list(self._lines.values())
 
     def get_order_line(self, order_line_id):
-        return self._lines[self._idx_from_id(order_line_id)]
+        return self._get_line(order_line_id)
 
     def delete_order_line(self, order_line_id):
         assert not self._finished, "finished orders may not be modified"
-        del self._lines[self._idx_from_id(order_line_id)]
+        try:
+            order_line = self._lines.pop(order_line_id)
+        except KeyError:
+            raise KeyError("invalid order_line_id")
+        self._total -= order_line.price_subtotal
 
     def add_order_line(self, product, qty, comment=None):
         """add a Product() object with specified quantity to the cart"""
         assert not self._finished, "finished orders may not be modified"
         assert comment is None or isinstance(comment, str)
-        self._lines.append(ProductBasedOrderLine(product, qty, comment))
+        order_line = ProductBasedOrderLine(product, qty, comment)
+        self._lines[order_line.order_line_id] = order_line
+        self._total += order_line.price_subtotal
         # call update_quantity so that qty_rounding is checked
-        self.update_quantity(self._lines[-1].order_line_id, qty)
+        self.update_quantity(order_line.order_line_id, qty)
 
     def set_finished(self):
         self._finished = True
@@ -282,7 +510,8 @@ class AbstractOfflineShoppingBackend(AbstractShoppingBackend):
             products=products,
             generate_root_category=generate_root_category,
         )
-        self.orders = []
+        # order_id -> Order
+        self.orders = {}
 
     # ==============================
     # categories
@@ -324,13 +553,17 @@ class AbstractOfflineShoppingBackend(AbstractShoppingBackend):
         else:
             raise ProductNotFound()
 
-    def search_from_text(self, searchstr):
-        # 1. search by product code
+    def _search_products_from_code(self, searchstr):
+        """return a list with the product matching the code ``searchstr``, or an empty list"""
         try:
             matching_product = self.search_product_from_code(searchstr)
-            matching_product = [self.tree.get_product(matching_product)]
+            return [self.tree.get_product(matching_product)]
         except ProductNotFound:
-            matching_product = []
+            return []
+
+    def search_from_text(self, searchstr):
+        # 1. search by product code
+        matching_product = self._search_products_from_code(searchstr)
 
         # 2. search by string
         return (
@@ -338,6 +571,36 @@ class AbstractOfflineShoppingBackend(AbstractShoppingBackend):
             matching_product + self.tree.search_products(searchstr),
         )
 
+    def start_search_session(self):
+        return OfflineSearchSession(self)
+
+    def _load_categories_and_products(self):
+        """load categories and products from the data source for :meth:`load_catalog`
+
+        :return: (categories, products, root_category_id), or None if reloading is not supported.
+                 The root category must be contained in categories.
+        """
+        return None
+
+    def load_catalog(self):
+        loaded = self._load_categories_and_products()
+        if loaded is None:
+            return None
+        (categories, products, root_category_id) = loaded
+        return OfflineCategoryTree(
+            root_category_id=root_category_id,
+            categories=categories,
+            products=products,
+            generate_root_category=False,
+        )
+
+    def set_catalog(self, catalog):
+        # order lines reference the Product objects, so they stay unchanged
+        self.tree = catalog
+
+    def category_exists(self, categ_id):
+        return categ_id in self.tree.categories
+
     # ==============================
     # order handling
     # ==============================
@@ -346,26 +609,26 @@ class AbstractOfflineShoppingBackend(AbstractShoppingBackend):
     # use some uniqueIdFactory singleton class?
 
     def get_orders(self):
-        # return [(o.order_id, "todo title") for o in self.orders]
+        # return [(o.order_id, "todo title") for o in self.orders.values()]
         raise NotImplementedError()
 
     def create_order(self):
         new_order = Order()
-        self.orders.append(new_order)
-        return id(new_order)
+        self.orders[new_order.order_id] = new_order
+        return new_order.order_id
 
     def delete_current_order(self):
-        self.orders.remove(self._get_current_order_obj())
+        del self.orders[self._get_current_order_obj().order_id]
         self.set_current_order(None)
 
     def set_current_order(self, order_id):
         self._current_order = order_id
 
     def _get_order_by_id(self, order_id):
-        for i in self.orders:
-            if id(i) == order_id:
-                return i
-        raise KeyError("invalid order_id")
+        try:
+            return self.orders[order_id]
+        except KeyError:
+            raise KeyError("invalid order_id")
 
     def _get_current_order_obj(self):
         try:
@@ -389,6 +652,12 @@ class AbstractOfflineShoppingBackend(AbstractShoppingBackend):
     def update_quantity(self, order_line_id, amount):
         self._get_current_order_obj().update_quantity(order_line_id, amount)
 
+    def get_current_total(self):
+        # use the total maintained by Order instead of summing up all lines
+        if self.get_current_order() is None:
+            return self.round_money(0)
+        return self.round_money(self._get_current_order_obj().total)
+
     def product_requires_text_entry(self, prod_id):
         return self.tree.products[prod_id].text_entry_required
 
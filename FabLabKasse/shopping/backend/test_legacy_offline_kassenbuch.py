@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# FabLabKasse, a Point-of-Sale Software for FabLabs and other public and trust-based workshops.
+#
+# This program is free software: you can redistribute it and/or modify it under the terms of the GNU
+# General Public License as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with this program. If not,
+# see <http://www.gnu.org/licenses/>.
+
+"""unittests for legacy_offline_kassenbuch.py"""
+
+import unittest
+from decimal import Decimal
+import random
+import time
+import os
+import tempfile
+import threading
+import http.server
+import json
+import io
+from hypothesis import given
+from hypothesis.strategies import integers, lists, none, one_of, tuples
+from .abstract import Category, Product
+from unittest import mock
+from . import legacy_offline_kassenbuch
+from .legacy_offline_kassenbuch import (
+    remove_empty_categories,
+    load_json_from_url,
+    load_products_from_json,
+    iter_json_object_items,
+)
+
+
+def remove_empty_categories_iterative(products, categories):
+    """previous implementation, used as reference"""
+    for i in range(99):
+        keep_categories = [c.categ_id for c in categories if c.parent_id is None]
+        keep_categories += [c.parent_id for c in categories]
+        keep_categories += [p.categ_id for p in products]
+        categories = list([c for c in categories if c.categ_id in keep_categories])
+    return categories
+
+
+def make_catalog(parent_ids, product_categ_ids):
+    """create categories 0...n-1 with the given parents and products in the given categories"""
+    categories = [
+        Category(categ_id=i, name="categ {0}".format(i), parent_id=parent_id)
+        for i, parent_id in enumerate(parent_ids)
+    ]
+    products = [
+        Product(
+            prod_id=i,
+            name="prod {0}".format(i),
+            price=1,
+            unit="",
+            location="",
+            categ_id=categ_id,
+        )
+        for i, categ_id in enumerate(product_categ_ids)
+    ]
+    return (products, categories)
+
+
+class RemoveEmptyCategoriesTestCase(unittest.TestCase):
+
+    """Test remove_empty_categories"""
+
+    def test_example(self):
+        """remove a branch without products, keep the root"""
+        # 0 -> 1 -> 2 -> 3 (product)
+        #        -> 4 -> 5
+        # 6 (root without products)
+        (products, categories) = make_catalog([None, 0, 1, 2, 1, 4, None], [3])
+        self.assertEqual(
+            [c.categ_id for c in remove_empty_categories(products, categories)],
+            [0, 1, 2, 3, 6],
+        )
+
+    @given(
+        tuples(
+            lists(one_of(none(), integers(0, 30)), max_size=30),
+            lists(one_of(none(), integers(0, 40)), max_size=10),
+        )
+    )
+    def test_like_iterative(self, catalog):
+        """compare with the previous implementation, including invalid and cyclic parents"""
+        (products, categories) = make_catalog(*catalog)
+        self.assertEqual(
+            remove_empty_categories(products, categories),
+            remove_empty_categories_iterative(products, categories),
+        )
+
+    def test_benchmark(self):
+        """synthetic catalog with 5000 categories and 50000 products"""
+        rand = random.Random(42)
+        parent_ids = [None]
+        for i in range(1, 5000):
+            parent_ids.append(rand.randrange(i))
+        product_categ_ids = [rand.randrange(2500, 5000) for i in range(50000)]
+        (products, categories) = make_catalog(parent_ids, product_categ_ids)
+        start = time.perf_counter()
+        result = remove_empty_categories(products, categories)
+        duration = time.perf_counter() - start
+        self.assertLess(duration, 1, "remove_empty_categories is too slow")
+        self.assertLess(len(result), len(categories))
+        kept = set(c.categ_id for c in result)
+        for c in result:
+            self.assertTrue(c.parent_id is None or c.parent_id in kept)
+
+
+class CatalogRequestHandler(http.server.BaseHTTPRequestHandler):
+
+    """stand-in for the pricelist server, supports ETag revalidation"""
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append(self.headers.get("If-None-Match"))
+        etag = '"{0}"'.format(hash(server.content))
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("ETag", etag)
+        self.send_header("Content-Type", "application/json")
+        self.end_headers()
+        self.wfile.write(server.content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class DownloadTestCase(unittest.TestCase):
+
+    """Test the cached download of the catalog"""
+
+    def setUp(self):
+        self.old_cwd = os.getcwd()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        os.chdir(self.tmpdir.name)
+        self.server = http.server.ThreadingHTTPServer(
+            ("127.0.0.1", 0), CatalogRequestHandler
+        )
+        self.server.content = b'{"a": 1}'
+        self.server.requests = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = "http://127.0.0.1:{0}/products.json".format(self.server.server_port)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        os.chdir(self.old_cwd)
+        self.tmpdir.cleanup()
+
+    def test_download(self):
+        """download, revalidate, max_age and fallback to the cached file"""
+        self.assertEqual(load_json_from_url(self.url), {"a": 1})
+        self.assertEqual(self.server.requests, [None])
+        self.assertEqual(load_json_from_url(self.url), {"a": 1})
+        etag = self.server.requests[1]
+        self.assertIsNotNone(etag)
+        # fresh cache: no request
+        self.assertEqual(load_json_from_url(self.url, max_age=3600), {"a": 1})
+        self.assertEqual(len(self.server.requests), 2)
+
+        self.server.content = b'{"a": 2}'
+        self.assertEqual(load_json_from_url(self.url), {"a": 2})
+        self.assertEqual(self.server.requests[2], etag)
+
+        # invalid data keeps the cached version
+        self.server.content = b'{"a": '
+        self.assertEqual(load_json_from_url(self.url), {"a": 2})
+        self.assertEqual(len(os.listdir("out")), 2, "temporary files left")
+
+        # server not reachable
+        self.server.shutdown()
+        self.server.server_close()
+        self.assertEqual(load_json_from_url(self.url), {"a": 2})
+
+
+def product_json(code, name, price, categ_id=42, rounding=1.0):
+    """one entry of the product JSON, with some of the unused fields"""
+    return {
+        "code": code,
+        "name": name,
+        "lst_price": price,
+        "_uom_str": "Stück",
+        "_location_str": "Regal",
+        "categ_id": [categ_id, "Alle Produkte / Test"],
+        "_uom_rounding": rounding,
+        "_supplierinfo": {"qty": 108.0, "delay": 1},
+        "seller_ids": [2293],
+    }
+
+
+class JSONObjectItemsTestCase(unittest.TestCase):
+
+    """Test iter_json_object_items"""
+
+    def test_items(self):
+        """items must equal json.loads() for any chunk size"""
+        for data in [
+            "{}",
+            ' { "a" : 1 } ',
+            '{"a": 1, "b": [1, 2.5e3, "x"], "ü\\"": {"c": null}, "d": true, "e": -12345}',
+            json.dumps({str(i): {"x": "ä" * i, "y": i} for i in range(20)}),
+        ]:
+            for chunk_size in [1, 2, 3, 7, 100]:
+                self.assertEqual(
+                    list(
+                        iter_json_object_items(
+                            io.BytesIO(data.encode("utf8")), chunk_size=chunk_size
+                        )
+                    ),
+                    list(json.loads(data).items()),
+                    "chunk size {0}: {1}".format(chunk_size, data),
+                )
+
+    def test_invalid(self):
+        """invalid JSON raises ValueError"""
+        for data in [
+            "",
+            "[]",
+            '{"a": 1',
+            '{"a" 1}',
+            '{"a": 1,}',
+            '{"a": 1} x',
+            "{1: 2}",
+        ]:
+            with self.assertRaises(ValueError, msg=data):
+                list(iter_json_object_items(io.BytesIO(data.encode("utf8")), 2))
+
+
+def product_values(product):
+    """all attributes of a Product, for comparison"""
+    return [getattr(product, attr) for attr in Product.__slots__]
+
+
+class CompiledProductsTestCase(unittest.TestCase):
+
+    """Test load_products_from_json"""
+
+    def test_compiled_products(self):
+        """the compiled product list is used until the JSON changes"""
+        data = json.dumps(
+            {
+                "0834": product_json("0834", "Scheibe", 0.15),
+                "0835": product_json("0835", "gratis", 0),
+                "9212": product_json("9212", "Kommentar / Preis", 1, 44, 0.01),
+            }
+        ).encode("utf8")
+        with tempfile.TemporaryDirectory() as d:
+            compiled = d + "/products.sqlite3"
+            products = load_products_from_json(io.BytesIO(data), compiled)
+            self.assertEqual(
+                [product_values(p) for p in products],
+                [product_values(p) for p in load_products_from_json(io.BytesIO(data))],
+            )
+            self.assertEqual([p.prod_id for p in products], [834, 9212])
+            self.assertEqual(products[1].qty_rounding, Decimal("0.01"))
+            self.assertTrue(products[1].text_entry_required)
+
+            with mock.patch.object(
+                legacy_offline_kassenbuch,
+                "iter_json_object_items",
+                side_effect=AssertionError("parsed"),
+            ):
+                cached = load_products_from_json(io.BytesIO(data), compiled)
+            self.assertEqual(
+                [product_values(p) for p in cached],
+                [product_values(p) for p in products],
+            )
+
+            data = json.dumps({"0834": product_json("0834", "Scheibe", 0.2)})
+            data = data.encode("utf8")
+            self.assertEqual(
+                [p.price for p in load_products_from_json(io.BytesIO(data), compiled)],
+                [Decimal("0.2")],
+            )
+
+            # a broken file is ignored and replaced
+            with open(compiled, "wb") as f:
+                f.write(b"garbage")
+            self.assertEqual(
+                len(load_products_from_json(io.BytesIO(data), compiled)), 1
+            )
+            with mock.patch.object(
+                legacy_offline_kassenbuch,
+                "iter_json_object_items",
+                side_effect=AssertionError("parsed"),
+            ):
+                self.assertEqual(
+                    len(load_products_from_json(io.BytesIO(data), compiled)), 1
+                )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,350 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# FabLabKasse, a Point-of-Sale Software for FabLabs and other public and trust-based workshops.
+#
+# This program is free software: you can redistribute it and/or modify it under the terms of the GNU
+# General Public License as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with this program. If not,
+# see <http://www.gnu.org/licenses/>.
+
+"""unittests for offline_base.py"""
+
+import unittest
+import tracemalloc
+from decimal import Decimal
+from unittest import mock
+from configparser import ConfigParser
+from hypothesis import given
+from hypothesis.strategies import decimals, lists, sampled_from, tuples
+from natsort import natsorted
+from .abstract import Category, Product
+from .offline_base import OfflineCategoryTree, SearchIndex, simplify_searchstring
+from . import dummy
+
+
+def dummy_backend():
+    """create the dummy shopping backend with a minimal config"""
+    cfg = ConfigParser()
+    cfg.read_string(
+        "[payup_methods]\n"
+        "overpayment_product_id = 9999\n"
+        "payout_impossible_product_id = 9994\n"
+    )
+    with mock.patch("FabLabKasse.scriptHelper.getConfig", return_value=cfg):
+        return dummy.ShoppingBackend(cfg)
+
+
+WORDS = ["Acryl", "3mm", "10mm", "Holz", "Sperrholz", "PLA", "Filament", "‐", "  "]
+
+
+def naive_search(names, searchstr):
+    """reference implementation: check every name"""
+    keywords = simplify_searchstring(searchstr).split(" ")
+    result = [
+        key
+        for key, name in names.items()
+        if all(keyword in simplify_searchstring(name) for keyword in keywords)
+    ]
+    return natsorted(result, key=lambda key: simplify_searchstring(names[key]))
+
+
+class SearchIndexTestCase(unittest.TestCase):
+
+    """Test SearchIndex"""
+
+    def test_search(self):
+        """test some search strings"""
+        index = SearchIndex()
+        names = ["Acrylglas 10mm", "Acrylglas 3mm", "Sperrholz 3mm", "﻿PLA  Filament"]
+        for key, name in enumerate(names):
+            index.add(key, name)
+        self.assertEqual(index.search(""), [1, 0, 3, 2])
+        self.assertEqual(index.search("3MM"), [1, 2])
+        self.assertEqual(index.search("mm acryl"), [1, 0])
+        self.assertEqual(index.search("pla filament"), [3])
+        self.assertEqual(index.search("a f"), [3])
+        self.assertEqual(index.search("acrylglas 4mm"), [])
+        index.add(4, "Acrylglas 5mm")
+        self.assertEqual(index.search("acryl"), [1, 4, 0])
+
+    @given(
+        names=lists(lists(sampled_from(WORDS + [" "]), max_size=6).map("".join)),
+        searchstr=lists(sampled_from(WORDS + ["a", "rh", "m ", "mm"]), max_size=3).map(
+            "".join
+        ),
+    )
+    def test_search_like_scan(self, names, searchstr):
+        """compare search results with scanning all names"""
+        names = dict(enumerate(names))
+        index = SearchIndex()
+        for key, name in names.items():
+            index.add(key, name)
+        self.assertEqual(index.search(searchstr), naive_search(names, searchstr))
+
+
+class OfflineCategoryTreeTestCase(unittest.TestCase):
+
+    """Test OfflineCategoryTree"""
+
+    def test_navigation(self):
+        """subcategories and products of each category"""
+        tree = dummy_backend().tree
+        for categ_id in list(tree.categories) + [None, 12345]:
+            self.assertEqual(
+                tree.get_subcategories(categ_id),
+                natsorted(
+                    [c for c in tree.categories.values() if c.parent_id == categ_id],
+                    key=lambda c: simplify_searchstring(c.name),
+                ),
+            )
+            self.assertEqual(
+                tree.get_products(categ_id),
+                natsorted(
+                    [p for p in tree.products.values() if p.categ_id == categ_id],
+                    key=lambda p: simplify_searchstring(p.name),
+                ),
+            )
+        self.assertEqual(
+            [c.name for c in tree.get_subcategories(7)],
+            ["Laser Material", "Laser Time"],
+        )
+        # modifying the tree updates the cached lists
+        tree.add_category(Category(categ_id=5, name="Laser Cutting", parent_id=7))
+        tree.add_product(
+            Product(
+                prod_id=5,
+                name="Acrylic 2mm",
+                price=1,
+                unit="",
+                location="",
+                categ_id=42,
+            )
+        )
+        self.assertEqual(
+            [c.name for c in tree.get_subcategories(7)],
+            ["Laser Cutting", "Laser Material", "Laser Time"],
+        )
+        self.assertEqual(
+            [p.name for p in tree.get_products(42)], ["Acrylic 2mm", "Acrylic 3mm"]
+        )
+
+
+class OrderTestCase(unittest.TestCase):
+
+    """Test orders of the offline backend"""
+
+    def setUp(self):
+        self.backend = dummy_backend()
+
+    def test_order_lines(self):
+        """add, change and delete lines of a large cart"""
+        backend = self.backend
+        order_id = backend.create_order()
+        other_order_id = backend.create_order()
+        self.assertNotEqual(order_id, other_order_id)
+        backend.set_current_order(order_id)
+        for i in range(500):
+            backend.add_order_line(2000 + i % 50, 1)
+        lines = backend.get_order_lines()
+        self.assertEqual(len(lines), 500)
+        backend.update_quantity(lines[10].order_line_id, 3)
+        self.assertEqual(backend.get_order_line(lines[10].order_line_id).qty, 3)
+        backend.delete_order_line(lines[0].order_line_id)
+        self.assertEqual(backend.get_order_lines(), lines[1:])
+        with self.assertRaises(KeyError):
+            backend.get_order_line(lines[0].order_line_id)
+        with self.assertRaises(KeyError):
+            backend.delete_order_line(lines[0].order_line_id)
+
+        backend.delete_current_order()
+        self.assertIsNone(backend.get_current_order())
+        self.assertEqual(backend.get_current_total(), Decimal("0.00"))
+        self.assertEqual(list(backend.orders), [other_order_id])
+
+    @given(
+        operations=lists(
+            tuples(
+                sampled_from(["add", "update", "delete"]),
+                sampled_from([1, 2, 123, 9212, 2000, 2013, 2149]),
+                decimals(min_value=0, max_value=1000, places=3),
+            ),
+            max_size=30,
+        )
+    )
+    def test_total(self, operations):
+        """the maintained total equals the sum of all lines after every change"""
+        backend = self.backend
+        backend.set_current_order(backend.create_order())
+        for (operation, prod_id, qty) in operations:
+            lines = backend.get_order_lines()
+            if operation == "add" or not lines:
+                backend.add_order_line(prod_id, qty)
+            elif operation == "update":
+                backend.update_quantity(lines[prod_id % len(lines)].order_line_id, qty)
+            else:
+                backend.delete_order_line(lines[prod_id % len(lines)].order_line_id)
+            subtotals = [line.price_subtotal for line in backend.get_order_lines()]
+            self.assertEqual(backend._get_current_order_obj().total, sum(subtotals))
+            self.assertEqual(
+                backend.get_current_total(), backend.round_money(sum(subtotals))
+            )
+        backend.delete_current_order()
+        self.assertEqual(backend.get_current_total(), Decimal("0.00"))
+
+
+class MemoryTestCase(unittest.TestCase):
+
+    """memory benchmark for the catalog"""
+
+    # words for product names of realistic length (about 40 characters)
+    MATERIALS = ["Acrylglas", "Sperrholz", "PLA Filament", "Aluminiumprofil"]
+    MATERIALS += ["Widerstand", "Schrumpfschlauch", "Kabelbinder", "Lötzinn"]
+    PROPERTIES = ["schwarz", "transparent", "verzinkt", "Edelstahl", "glänzend"]
+    PROPERTIES += ["selbstklebend", "bleifrei"]
+
+    def product_name(self, i):
+        return "{0} {1} {2}x{3}mm {4} Art.{5}".format(
+            self.MATERIALS[i % len(self.MATERIALS)],
+            self.PROPERTIES[i % len(self.PROPERTIES)],
+            i % 487 + 1,
+            i % 97 + 1,
+            self.PROPERTIES[i // 11 % len(self.PROPERTIES)],
+            i,
+        )
+
+    def test_bytes_per_product(self):
+        """load a catalog with 50000 products and check the memory per product"""
+        num_products = 50000
+        price = Decimal("1.50")
+        categories = [
+            Category(categ_id=i, name="Kategorie {0}".format(i), parent_id=0)
+            for i in range(1, 101)
+        ]
+        tracemalloc.start()
+        try:
+            products = [
+                Product(
+                    prod_id=i,
+                    name=self.product_name(i),
+                    price=price,
+                    unit="Stück",
+                    location="Regal",
+                    categ_id=i % 100 + 1,
+                )
+                for i in range(num_products)
+            ]
+            bytes_per_product = tracemalloc.get_traced_memory()[0] / num_products
+            cfg = ConfigParser()
+            cfg.read_string(
+                "[payup_methods]\n"
+                "overpayment_product_id = 1\n"
+                "payout_impossible_product_id = 2\n"
+            )
+            with mock.patch("FabLabKasse.scriptHelper.getConfig", return_value=cfg):
+                tree = OfflineCategoryTree(0, categories, products)
+            bytes_per_product_in_tree = (
+                tracemalloc.get_traced_memory()[0] / num_products
+            )
+            # the search index is built on the first search
+            self.assertEqual(len(tree.search_product_ids("art.4711")), 11)
+            bytes_per_product_searched = (
+                tracemalloc.get_traced_memory()[0] / num_products
+            )
+        finally:
+            tracemalloc.stop()
+        self.assertEqual(len(tree.products), num_products)
+        self.assertFalse(hasattr(products[0], "__dict__"))
+        # Product object (96 bytes on 64bit CPython), name and id
+        self.assertLess(bytes_per_product, 300, "bytes per Product")
+        # including simplified name and category index
+        self.assertLess(bytes_per_product_in_tree, 1000, "bytes per product in tree")
+        # including search index
+        self.assertLess(
+            bytes_per_product_searched, 1500, "bytes per product with search index"
+        )
+
+
+class CatalogReloadTestCase(unittest.TestCase):
+
+    """Test load_catalog() and set_catalog()"""
+
+    def test_reload(self):
+        """new prices are used for new order lines only"""
+        backend = dummy_backend()
+        self.assertIsNone(backend.load_catalog())
+        backend.set_current_order(backend.create_order())
+        backend.add_order_line(123, 1)
+
+        categories = list(backend.tree.categories.values())
+        products = [
+            Product(
+                prod_id=p.prod_id,
+                name=p.name,
+                price=p.price * 2,
+                unit=p.unit,
+                location=p.location,
+                categ_id=p.categ_id,
+            )
+            for p in backend.tree.products.values()
+        ]
+        backend._load_categories_and_products = lambda: (categories, products, 0)
+        with mock.patch("FabLabKasse.scriptHelper.getConfig", return_value=backend.cfg):
+            catalog = backend.load_catalog()
+        self.assertEqual(backend.get_products(42)[0].price, Decimal("11.31"))
+        backend.set_catalog(catalog)
+        self.assertEqual(backend.get_products(42)[0].price, Decimal("22.62"))
+        self.assertTrue(backend.category_exists(42))
+        self.assertFalse(backend.category_exists(4711))
+        backend.add_order_line(123, 1)
+        self.assertEqual(
+            [line.price_subtotal for line in backend.get_order_lines()],
+            [Decimal("11.31"), Decimal("22.62")],
+        )
+
+
+class SearchSessionTestCase(unittest.TestCase):
+
+    """Test OfflineSearchSession"""
+
+    def test_typing(self):
+        """results while typing and deleting must equal searching from scratch"""
+        backend = dummy_backend()
+        session = backend.start_search_session()
+        typed = ["l", "la", "las", "lase", "laser ", "laser t", "laser", "lase"]
+        typed += ["", "1", "12", "123", "12", "po", "pot 1", "pot 12", "pot 1"]
+        typed += ["Pot  1", "pot 1 X"]
+        for searchstr in typed:
+            self.assertEqual(
+                session.search(searchstr),
+                backend.search_from_text(searchstr),
+                "search string {0}".format(repr(searchstr)),
+            )
+        self.assertEqual(
+            backend.start_search_session().search("123")[1][0].prod_id, 123
+        )
+
+    def test_refine_only_previous_results(self):
+        """an extended search string only checks the previous results"""
+        backend = dummy_backend()
+        session = backend.start_search_session()
+        session.search("potatoes size 4")
+        with mock.patch.object(
+            SearchIndex, "_postings", side_effect=AssertionError("full search")
+        ):
+            self.assertEqual(
+                [p.name for p in session.search("potatoes size 42")[1]],
+                ["Potatoes Size 42"] * 50,
+            )
+            # backspace
+            self.assertEqual(len(session.search("potatoes size 4")[1]), 14 * 50)
+
+
+if __name__ == "__main__":
+    unittest.main()
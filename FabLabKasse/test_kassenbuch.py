@@ -26,6 +26,10 @@ from .kassenbuch import (
     Rechnung,
     NoDataFound,
     parse_args,
+    BULK_QUERY_CHUNK_SIZE,
+    SCHEMA_VERSION_INTEGER_CENTS,
+    BuchungTotalsAggregate,
+    date2str,
 )
 from .kassenbuch import argparse_parse_date, argparse_parse_currency
 from hypothesis import given, reproduce_failure
@@ -37,7 +41,10 @@ import subprocess
 import os
 import random
 import tempfile
+import configparser
+import argparse
 from pathlib import Path
+from unittest import mock
 
 
 class KassenbuchTestCase(unittest.TestCase):
@@ -106,6 +113,7 @@ class KassenbuchTestCase(unittest.TestCase):
             return result.stdout
 
         call_kb("summary")
+        call_kb("checkpoints verify")
         call_kb("show")
         call_kb("client list")
         randstr = str(random.randint(0, int(1e30)))
@@ -213,3 +221,490 @@ class KassenbuchTestCase(unittest.TestCase):
             self.assertTrue(query)
         else:
             self.assertFalse(query)
+
+    def test_bulk_loading(self):
+        """test that get_rechnungen and get_buchungen return the same as loading by id"""
+        kasse = Kasse(sqlite_file=":memory:")
+        # more invoices than fit into one "IN (...)" query
+        for i in range(BULK_QUERY_CHUNK_SIZE + 3):
+            rechnung = Rechnung(datum=datetime(2020, 1, 1) + timedelta(hours=i))
+            for j in range(i % 4):
+                rechnung.add_position(
+                    f"Artikel {j}",
+                    Decimal("1.5") * j,
+                    anzahl=Decimal(i),
+                    einheit="Stk",
+                    produkt_ref=f"{j:04}",
+                )
+            rechnung.store(kasse.cur)
+            b1 = Buchung("Handkasse", rechnung.summe, rechnung=rechnung.id)
+            b2 = Buchung(
+                "Besucher", -rechnung.summe, rechnung=rechnung.id, datum=b1.datum
+            )
+            kasse.buchen([b1, b2])
+
+        rechnungen = kasse.get_rechnungen()
+        self.assertEqual(len(rechnungen), BULK_QUERY_CHUNK_SIZE + 3)
+        for r in rechnungen:
+            reference = Rechnung.load_from_id(r.id, kasse.cur)
+            self.assertEqual(r.datum, reference.datum)
+            self.assertEqual(r.positionen, reference.positionen)
+
+        buchungen = kasse.get_buchungen(from_date=datetime(2020, 1, 2))
+        self.assertTrue(buchungen)
+        for b in buchungen:
+            self.assertEqual(repr(b), repr(Buchung.load_from_id(b.id, kasse.cur)))
+
+    def test_iterators(self):
+        """test that the iter_* functions return the same as the list-based functions"""
+        kasse = Kasse(sqlite_file=":memory:")
+        for i in range(7):
+            rechnung = Rechnung(datum=datetime(2021, 1, 1) + timedelta(days=i))
+            rechnung.add_position("Artikel", Decimal("0.25"), anzahl=Decimal(i))
+            rechnung.store(kasse.cur)
+            b1 = Buchung("Handkasse", rechnung.summe, rechnung=rechnung.id)
+            b2 = Buchung(
+                "Besucher", -rechnung.summe, rechnung=rechnung.id, datum=b1.datum
+            )
+            kasse.buchen([b1, b2])
+            Kunde(f"kunde{i}", schuldengrenze=Decimal(i)).store(kasse.cur)
+        kasse.con.commit()
+
+        from_date = datetime(2021, 1, 3)
+        self.assertEqual(
+            [repr(b) for b in kasse.iter_buchungen(batch_size=3)],
+            [repr(b) for b in kasse.get_buchungen()],
+        )
+        self.assertEqual(
+            [(r.id, r.positionen) for r in kasse.iter_rechnungen(from_date, None, 2)],
+            [(r.id, r.positionen) for r in kasse.get_rechnungen(from_date, None)],
+        )
+        self.assertEqual(
+            [repr(k) for k in kasse.iter_kunden(batch_size=2)],
+            [repr(k) for k in kasse.kunden],
+        )
+        self.assertEqual(len(kasse.kunden), 7)
+
+    def test_kontostand_checkpoints(self):
+        """test the account balance checkpoints used by summary_to_string"""
+        kasse = Kasse(sqlite_file=":memory:")
+
+        def transfer(source, destination, amount, datum):
+            b1 = Buchung(source, -amount, kommentar="Test", datum=datum)
+            b2 = Buchung(destination, amount, kommentar="Test", datum=datum)
+            kasse.buchen([b1, b2])
+
+        transfer("Besucher", "Handkasse", Decimal("10.00"), datetime(2022, 1, 1, 10))
+        transfer("Besucher", "Handkasse", Decimal("2.50"), datetime(2022, 1, 3, 10))
+        transfer("Handkasse", "Bank", Decimal("5.00"), datetime(2022, 1, 3, 12))
+        # booking in the past
+        transfer("Besucher", "Handkasse", Decimal("0.01"), datetime(2022, 1, 2, 10))
+        self.assertEqual(kasse.verify_kontostand(), [])
+
+        summary = kasse.summary_to_string(datetime(2022, 1, 3, 11))
+        self.assertIn("Handkasse             12.51       0.00      12.51 EUR", summary)
+        self.assertIn("Besucher               0.00      12.51     -12.51 EUR", summary)
+        self.assertNotIn("Bank", summary)
+        summary = kasse.summary_to_string(datetime(2022, 1, 4))
+        self.assertIn("Handkasse             12.51       5.00       7.51 EUR", summary)
+        self.assertIn("Bank                   5.00       0.00       5.00 EUR", summary)
+        self.assertIn("0 EUR", kasse.summary_to_string(datetime(2021, 12, 31)))
+
+        kasse.cur.execute("UPDATE kontostand SET saldo = '0'")
+        self.assertTrue(kasse.verify_kontostand())
+        kasse.rebuild_kontostand()
+        self.assertEqual(kasse.verify_kontostand(), [])
+
+    def test_sub_cent_amounts(self):
+        """new bookings must be whole cents, older ones with more places are summed exactly"""
+        with tempfile.TemporaryDirectory() as d:
+            kasse = Kasse(sqlite_file=f"{d}/kasse.sqlite3")
+            datum = datetime(2022, 2, 1, 10)
+            with self.assertRaises(ValueError):
+                kasse.buchen(
+                    [
+                        Buchung("Handkasse", Decimal("1.005"), kommentar="Test"),
+                        Buchung("Besucher", Decimal("-1.005"), kommentar="Test"),
+                    ]
+                )
+            self.assertEqual(kasse.get_buchungen(), [])
+            with self.assertRaises(argparse.ArgumentTypeError):
+                argparse_parse_currency("1,005")
+
+            # database of an older version without checkpoints
+            for konto, betrag in [("Handkasse", "1.005"), ("Besucher", "-1.005")]:
+                Buchung(konto, Decimal(betrag), kommentar="Test", datum=datum)._store(
+                    kasse.cur
+                )
+            kasse.cur.execute("DROP TABLE kontostand")
+            kasse.con.commit()
+            kasse = Kasse(sqlite_file=f"{d}/kasse.sqlite3")
+            self.assertEqual(kasse.verify_kontostand(), [])
+            kasse.buchen(
+                [
+                    Buchung(
+                        "Handkasse", Decimal("2.00"), kommentar="Test", datum=datum
+                    ),
+                    Buchung(
+                        "Besucher", Decimal("-2.00"), kommentar="Test", datum=datum
+                    ),
+                ]
+            )
+            self.assertEqual(kasse.verify_kontostand(), [])
+            self.assertEqual(
+                kasse.cur.execute(
+                    "SELECT haben, soll, saldo FROM kontostand WHERE konto='Handkasse'"
+                ).fetchall(),
+                [("3.005", "0.00", "3.005")],
+            )
+
+    def test_account_totals(self):
+        """test that account_totals matches summing up the bookings in Python"""
+        kasse = Kasse(sqlite_file=":memory:")
+        amounts = ["0.01", "12.34", "1000000.99", "0.10", "3.33"]
+        for i, amount in enumerate(amounts):
+            datum = datetime(2023, 1, 1) + timedelta(days=i)
+            b1 = Buchung("Besucher", -Decimal(amount), kommentar="Test", datum=datum)
+            b2 = Buchung(
+                f"Konto{i % 2}", Decimal(amount), kommentar="Test", datum=datum
+            )
+            kasse.buchen([b1, b2])
+
+        from_date = datetime(2023, 1, 2)
+        until_date = datetime(2023, 1, 5)
+        expected = {}
+        for b in kasse.get_buchungen(from_date, until_date):
+            haben, soll, saldo = expected.get(b.konto, (0, 0, 0))
+            expected[b.konto] = (
+                haben + max(b.betrag, 0),
+                soll + max(-b.betrag, 0),
+                saldo + b.betrag,
+            )
+        self.assertEqual(kasse.account_totals(from_date, until_date), expected)
+        self.assertEqual(
+            kasse.account_totals()["Besucher"],
+            (Decimal(0), Decimal("1000016.77"), Decimal("-1000016.77")),
+        )
+        self.assertEqual(kasse.account_totals(until_date=datetime(2000, 1, 1)), {})
+
+    def test_account_totals_sub_cent(self):
+        """test account_totals with amounts that are not whole cents (older databases)"""
+        kasse = Kasse(sqlite_file=":memory:")
+        datum = datetime(2023, 2, 1)
+        for konto, betrag in [
+            ("Handkasse", "1.005"),
+            ("Handkasse", "2.50"),
+            ("Besucher", "-3.505"),
+            ("Rundung", "0.0001"),
+        ]:
+            Buchung(konto, Decimal(betrag), kommentar="Test", datum=datum)._store(
+                kasse.cur
+            )
+        kasse.con.commit()
+
+        expected = {
+            "Besucher": (Decimal(0), Decimal("3.505"), Decimal("-3.505")),
+            "Handkasse": (Decimal("3.505"), Decimal(0), Decimal("3.505")),
+            "Rundung": (Decimal("0.0001"), Decimal(0), Decimal("0.0001")),
+        }
+        self.assertEqual(kasse.account_totals(), expected)
+        kasse.migrate_to_integer_cents()
+        self.assertEqual(kasse.account_totals(), expected)
+        self.assertEqual(kasse.account_totals(until_date=datum), {})
+
+    def test_migrate_to_integer_cents(self):
+        """test the migration to integer columns for amounts of money"""
+        kasse = Kasse(sqlite_file=":memory:")
+
+        def sell(price, anzahl):
+            rechnung = Rechnung()
+            rechnung.add_position("Artikel", price, anzahl=anzahl)
+            rechnung.store(kasse.cur)
+            b1 = Buchung("Handkasse", rechnung.summe, rechnung=rechnung.id)
+            b2 = Buchung(
+                "Besucher", -rechnung.summe, rechnung=rechnung.id, datum=b1.datum
+            )
+            kasse.buchen([b1, b2])
+            return rechnung
+
+        sell(Decimal("0.015"), Decimal("100"))
+        kunde = Kunde("migration", schuldengrenze=Decimal(0))
+        kunde.store(kasse.cur)
+        # not convertible, only older versions stored such amounts
+        kasse.cur.execute(
+            "INSERT INTO kundenbuchung (datum, kunde, betrag, kommentar) "
+            + "VALUES ('2020-01-01 00:00:00.000000', ?, '-1.005', 'Test')",
+            (kunde.id,),
+        )
+        kunde.add_buchung(Decimal("7.50"), kommentar="Test")
+        kunde.store(kasse.cur)
+        kasse.con.commit()
+        totals_before = kasse.account_totals()
+
+        self.assertEqual(kasse.schema_version, 0)
+        self.assertEqual(kasse.migrate_to_integer_cents(batch_size=1), 1)
+        self.assertEqual(kasse.schema_version, SCHEMA_VERSION_INTEGER_CENTS)
+        # running it again is harmless
+        self.assertEqual(kasse.migrate_to_integer_cents(), 1)
+
+        # the schema version is not queried again for every insert
+        statements = []
+        kasse.con.set_trace_callback(statements.append)
+        rechnung = sell(Decimal("1.52"), Decimal("0.25"))
+        kasse.con.set_trace_callback(None)
+        self.assertFalse([q for q in statements if "PRAGMA" in q])
+        self.assertEqual(
+            kasse.cur.execute(
+                "SELECT anzahl_micro, einzelpreis_micro FROM position ORDER BY id"
+            ).fetchall(),
+            [(100000000, 15000), (250000, 1520000)],
+        )
+        self.assertEqual(
+            kasse.cur.execute(
+                "SELECT betrag_cent FROM buchung WHERE rechnung=? ORDER BY id",
+                (rechnung.id,),
+            ).fetchall(),
+            [(38,), (-38,)],
+        )
+        self.assertEqual(
+            kasse.cur.execute(
+                "SELECT betrag_cent FROM kundenbuchung ORDER BY id"
+            ).fetchall(),
+            [(None,), (750,)],
+        )
+        self.assertEqual(totals_before["Handkasse"][2], Decimal("1.50"))
+        self.assertEqual(
+            kasse.account_totals()["Handkasse"],
+            (Decimal("1.88"), Decimal(0), Decimal("1.88")),
+        )
+
+    def test_rebuild_migrated(self):
+        """a migrated database is opened with the integer columns"""
+        with tempfile.TemporaryDirectory() as d:
+            kasse = Kasse(sqlite_file=f"{d}/kasse.sqlite3")
+            b1 = Buchung("Handkasse", Decimal("2.50"), kommentar="Test")
+            b2 = Buchung("Besucher", Decimal("-2.50"), kommentar="Test", datum=b1.datum)
+            kasse.buchen([b1, b2])
+            kasse.migrate_to_integer_cents()
+            kasse.cur.execute("DROP TABLE kontostand")
+            kasse.con.commit()
+
+            # the checkpoints are rebuilt without converting the TEXT column
+            with mock.patch.object(
+                BuchungTotalsAggregate, "step", side_effect=AssertionError("TEXT")
+            ):
+                kasse = Kasse(sqlite_file=f"{d}/kasse.sqlite3")
+            self.assertTrue(kasse.con.integer_cent_columns)
+            self.assertEqual(kasse.verify_kontostand(), [])
+
+    def test_kundensaldo(self):
+        """test the stored client balance and loading clients without transactions"""
+        with tempfile.TemporaryDirectory() as d:
+            kasse = Kasse(sqlite_file=f"{d}/kasse.sqlite3")
+            kunde = Kunde("saldo", schuldengrenze=Decimal(100))
+            kunde.store(kasse.cur)
+            for betrag in ["-1.50", "20"]:
+                kunde.add_buchung(Decimal(betrag), kommentar="Test")
+            kunde.store(kasse.cur)
+            # older versions stored amounts that are not whole cents
+            kasse.cur.execute(
+                "INSERT INTO kundenbuchung (datum, kunde, betrag, kommentar) "
+                + "VALUES ('2020-01-01 00:00:00.000000', ?, '-0.333', 'Test')",
+                (kunde.id,),
+            )
+            kasse.rebuild_kundensaldo()
+
+            lazy = Kunde.load_from_id(kunde.id, kasse.cur, load_buchungen=False)
+            self.assertEqual(lazy.buchungen, [])
+            self.assertEqual(lazy.summe, Decimal("18.167"))
+            lazy.add_buchung(Decimal("-5"), kommentar="Test")
+            self.assertEqual(lazy.summe, Decimal("13.167"))
+            lazy.store(kasse.cur)
+            kasse.con.commit()
+            self.assertEqual(lazy.summe, Decimal("13.167"))
+
+            full = Kunde.load_from_name("saldo", kasse.cur)
+            self.assertEqual(len(full.buchungen), 4)
+            self.assertEqual(full.summe, Decimal("13.167"))
+            # modify an existing transaction
+            full.buchungen[1].betrag = Decimal("10")
+            full.store(kasse.cur)
+            kasse.con.commit()
+            self.assertEqual(
+                Kunde.load_from_id(kunde.id, kasse.cur, load_buchungen=False).summe,
+                Decimal("3.167"),
+            )
+            self.assertEqual(kasse.verify_kundensaldo(), [])
+
+            # new transactions must be whole cents
+            rejected = Kunde.load_from_id(kunde.id, kasse.cur, load_buchungen=False)
+            rejected.add_buchung(Decimal("-0.001"), kommentar="Test")
+            with self.assertRaises(ValueError):
+                rejected.store(kasse.cur)
+            kasse.con.rollback()
+            self.assertEqual(kasse.verify_kundensaldo(), [])
+
+            # databases without the table get it filled when opened
+            kasse.cur.execute("DROP TABLE kundensaldo")
+            kasse.con.commit()
+            kasse = Kasse(sqlite_file=f"{d}/kasse.sqlite3")
+            self.assertEqual(kasse.verify_kundensaldo(), [])
+            self.assertEqual(
+                [k.summe for k in kasse.iter_kunden(load_buchungen=False)],
+                [Decimal("3.167")],
+            )
+
+    def test_connection_settings(self):
+        """test applying the [database] config section to the connection"""
+        cfg = configparser.ConfigParser()
+        cfg.read_string("[database]\nbusy_timeout = 1234\ncache_size = -2000\n")
+        with tempfile.TemporaryDirectory() as d:
+            kasse = Kasse(sqlite_file=f"{d}/kasse.sqlite3", cfg=cfg)
+            self.assertEqual(
+                kasse.cur.execute("PRAGMA journal_mode").fetchone()[0], "wal"
+            )
+            self.assertEqual(
+                kasse.cur.execute("PRAGMA busy_timeout").fetchone()[0], 1234
+            )
+            self.assertEqual(
+                kasse.cur.execute("PRAGMA cache_size").fetchone()[0], -2000
+            )
+            # full == 2
+            self.assertEqual(kasse.cur.execute("PRAGMA synchronous").fetchone()[0], 2)
+            # a second connection can read while the first one is writing
+            with kasse.transaction():
+                Buchung("Kasse", Decimal(1), kommentar="Test")._store(kasse.cur)
+                reader = Kasse(sqlite_file=f"{d}/kasse.sqlite3", cfg=cfg)
+                self.assertEqual(reader.get_buchungen(), [])
+            self.assertEqual(len(reader.get_buchungen()), 1)
+
+        cfg.read_string("[database]\njournal_mode = invalid\n")
+        with self.assertRaises(ValueError):
+            Kasse(sqlite_file=":memory:", cfg=cfg)
+
+    def test_list_kunden(self):
+        """test the client list and its filters"""
+        kasse = Kasse(sqlite_file=":memory:")
+        now = datetime(2024, 6, 1)
+        transactions = {
+            "active": [("-5", 1), ("10", 3)],
+            "inactive": [("-5", 40), ("4", 2)],
+            "zero": [("-5", 50), ("5", 50)],
+            "new": [],
+        }
+        for name, buchungen in transactions.items():
+            kunde = Kunde(name, schuldengrenze=Decimal(10))
+            kunde.store(kasse.cur)
+            for betrag, days_ago in buchungen:
+                kunde.add_buchung(
+                    Decimal(betrag), kommentar="Test", datum=now - timedelta(days_ago)
+                )
+            kunde.store(kasse.cur)
+        kasse.con.commit()
+
+        def names(**kwargs):
+            return [k.name for k, _, _ in kasse.list_kunden(now=now, **kwargs)]
+
+        self.assertEqual(names(), ["active", "inactive", "zero", "new"])
+        self.assertEqual(names(remove_zeros=True), ["active", "inactive"])
+        self.assertEqual(names(inactive_days=30), ["inactive", "zero"])
+        self.assertEqual(names(max_balance=Decimal(0)), ["inactive"])
+        # clients without transactions have a balance of zero
+        self.assertEqual(
+            names(max_balance=Decimal("0.01")), ["inactive", "zero", "new"]
+        )
+        self.assertEqual(
+            names(inactive_days=30, max_balance=Decimal(1), remove_zeros=True),
+            ["inactive"],
+        )
+
+        kunde, last_payment, last_charge = kasse.list_kunden(now=now)[0]
+        self.assertEqual(kunde.summe, Decimal(5))
+        self.assertEqual(last_payment, now - timedelta(3))
+        self.assertEqual(last_charge, now - timedelta(1))
+        self.assertEqual(kasse.list_kunden(now=now)[3][1:], (None, None))
+
+        # balances from older versions are compared exactly, not as float
+        kasse.cur.execute(
+            "INSERT INTO kundenbuchung (datum, kunde, betrag, kommentar) "
+            + "VALUES (?, 4, '-0.30000000000000001', 'Test')",
+            (date2str(now),),
+        )
+        kasse.rebuild_kundensaldo()
+        # (as float, both values are -0.3)
+        self.assertEqual(names(max_balance=Decimal("-0.3")), ["inactive", "new"])
+        self.assertEqual(
+            names(max_balance=Decimal("-0.30000000000000001")), ["inactive"]
+        )
+
+    def test_transaction(self):
+        """test storing a sale in one transaction with batched inserts"""
+        kasse = Kasse(sqlite_file=":memory:")
+        rechnung = Rechnung()
+        for i in range(300):
+            rechnung.add_position(f"Artikel {i}", Decimal("0.10"), anzahl=Decimal(i))
+        with kasse.transaction():
+            rechnung.store(kasse.cur)
+            b1 = Buchung("Handkasse", rechnung.summe, rechnung=rechnung.id)
+            b2 = Buchung(
+                "Besucher", -rechnung.summe, rechnung=rechnung.id, datum=b1.datum
+            )
+            kasse.buchen([b1, b2])
+            # buchen() joins the outer transaction
+            self.assertTrue(kasse.con.in_transaction)
+        self.assertFalse(kasse.con.in_transaction)
+
+        loaded = Rechnung.load_from_id(rechnung.id, kasse.cur)
+        self.assertEqual(loaded.positionen, rechnung.positionen)
+        self.assertEqual(repr(Buchung.load_from_id(b2.id, kasse.cur)), repr(b2))
+
+        # exceptions roll back the whole sale
+        with self.assertRaises(AssertionError):
+            with kasse.transaction():
+                rechnung = Rechnung()
+                rechnung.add_position("Artikel", Decimal(1))
+                rechnung.store(kasse.cur)
+                kasse.buchen([Buchung("Handkasse", Decimal(1), rechnung=rechnung.id)])
+        self.assertEqual(len(kasse.rechnungen), 1)
+        self.assertEqual(len(kasse.buchungen), 2)
+        self.assertEqual(kasse.verify_kontostand(), [])
+
+    def test_kunde_store_only_modified(self):
+        """regression benchmark: storing a client must not rewrite its whole history
+
+        The number of SQL statements issued by Kunde.store() must not depend on
+        the number of existing transactions.
+        """
+        kasse = Kasse(sqlite_file=":memory:")
+        statements = []
+
+        def store_cost(history_length):
+            kunde = Kunde(f"history{history_length}", schuldengrenze=Decimal(0))
+            kunde.store(kasse.cur)
+            for i in range(history_length):
+                kunde.add_buchung(Decimal("-0.01"), kommentar=f"Test {i}")
+            kunde.store(kasse.cur)
+            kasse.con.commit()
+
+            kunde = Kunde.load_from_id(kunde.id, kasse.cur)
+            kunde.add_buchung(Decimal("-1.00"), kommentar="Test")
+            statements.clear()
+            kasse.con.set_trace_callback(statements.append)
+            kunde.store(kasse.cur)
+            kasse.con.set_trace_callback(None)
+            kasse.con.commit()
+            return len(statements)
+
+        self.assertEqual(store_cost(2000), store_cost(10))
+
+        # modifications are still written
+        kunde = Kunde.load_from_name("history10", kasse.cur)
+        kunde.buchungen[0].kommentar = "modified"
+        kunde.email = "modified@example.org"
+        kunde.store(kasse.cur)
+        kasse.con.commit()
+        kunde = Kunde.load_from_name("history10", kasse.cur)
+        self.assertEqual(kunde.buchungen[0].kommentar, "modified")
+        self.assertEqual(kunde.email, "modified@example.org")
+        self.assertEqual(kunde.summe, Decimal("-1.10"))
+        self.assertEqual(kasse.verify_kundensaldo(), [])